@@ -1,26 +1,31 @@
 from __future__ import annotations
 
-from typing import Any
+from typing import Any, Callable, Iterable
+import asyncio
 import contextvars
 import copy
+import functools
+import hashlib
 import json
 import os
 import time
 import uuid
 import html
 
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, Response
 from openai import APIStatusError, AsyncOpenAI
 from pydantic import BaseModel, ConfigDict, Field
 import httpx
 from mcp.client.session import ClientSession
 from mcp.client.streamable_http import streamable_http_client
+import orjson
 import tiktoken
 from prometheus_client import Counter, Histogram, Gauge, CONTENT_TYPE_LATEST, generate_latest
-from pythonjsonlogger import jsonlogger
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
@@ -59,10 +64,36 @@ class ContextFilter(logging.Filter):
         return True
 
 
+def _log_serializer(obj: Any) -> str:
+    return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+_LOG_RECORD_RESERVED = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "trace_id", "span_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload: dict[str, Any] = {
+            "asctime": self.formatTime(record),
+            "levelname": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "trace_id": getattr(record, "trace_id", None),
+            "span_id": getattr(record, "span_id", None),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_RESERVED:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            payload["stack_info"] = self.formatStack(record.stack_info)
+        return _log_serializer(payload)
+
+
 handler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter(
-    "%(asctime)s %(levelname)s %(name)s %(message)s %(request_id)s %(trace_id)s %(span_id)s"
-)
+formatter = JsonFormatter()
 handler.setFormatter(formatter)
 root_logger = logging.getLogger()
 root_logger.handlers = [handler]
@@ -71,7 +102,13 @@ root_logger.addFilter(ContextFilter())
 if OTEL_LOG_LEVEL:
     logging.getLogger("opentelemetry").setLevel(OTEL_LOG_LEVEL)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    await _close_openai_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 
 logger = logging.getLogger("agent")
 
@@ -104,42 +141,56 @@ REQUEST_LATENCY = Histogram(
     ["method", "path", "status"],
 )
 IN_FLIGHT = Gauge("http_in_flight_requests", "In-flight HTTP requests")
+_STATUS_LABELS = {code: str(code) for code in range(100, 600)}
+
+
+def _route_label(request: Request) -> str:
+    route = request.scope.get("route")
+    path = getattr(route, "path", None)
+    return path if isinstance(path, str) and path else "unknown"
 
 
 @app.middleware("http")
 async def observability_middleware(request: Request, call_next):
-    request_id = request.headers.get("x-request-id") or request.headers.get("x-correlation-id") or str(uuid.uuid4())
+    request_id = request.headers.get("x-request-id") or request.headers.get("x-correlation-id") or uuid.uuid4().hex
     token = request_id_ctx.set(request_id)
-    start = time.time()
+    method = request.method
+    path = request.url.path
+    start_ns = time.perf_counter_ns()
     if METRICS_ENABLED:
         IN_FLIGHT.inc()
     try:
         response = await call_next(request)
     except Exception as exc:
-        duration = time.time() - start
+        duration_ns = time.perf_counter_ns() - start_ns
         if METRICS_ENABLED:
-            REQUEST_COUNT.labels(request.method, request.url.path, "500").inc()
-            REQUEST_LATENCY.labels(request.method, request.url.path, "500").observe(duration)
+            route_label = _route_label(request)
+            REQUEST_COUNT.labels(method, route_label, "500").inc()
+            REQUEST_LATENCY.labels(method, route_label, "500").observe(duration_ns / 1e9)
             IN_FLIGHT.dec()
         logger.exception("http_error", extra={
-            "method": request.method,
-            "path": request.url.path,
+            "method": method,
+            "path": path,
             "status": 500,
-            "duration_ms": int(duration * 1000),
+            "duration_ms": duration_ns // 1_000_000,
         })
         request_id_ctx.reset(token)
         raise exc
-    duration = time.time() - start
+    duration_ns = time.perf_counter_ns() - start_ns
+    status = response.status_code
     if METRICS_ENABLED:
-        REQUEST_COUNT.labels(request.method, request.url.path, str(response.status_code)).inc()
-        REQUEST_LATENCY.labels(request.method, request.url.path, str(response.status_code)).observe(duration)
+        status_label = _STATUS_LABELS.get(status) or str(status)
+        route_label = _route_label(request)
+        REQUEST_COUNT.labels(method, route_label, status_label).inc()
+        REQUEST_LATENCY.labels(method, route_label, status_label).observe(duration_ns / 1e9)
         IN_FLIGHT.dec()
-    logger.info("http_request", extra={
-        "method": request.method,
-        "path": request.url.path,
-        "status": response.status_code,
-        "duration_ms": int(duration * 1000),
-    })
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("http_request", extra={
+            "method": method,
+            "path": path,
+            "status": status,
+            "duration_ms": duration_ns // 1_000_000,
+        })
     response.headers["x-request-id"] = request_id
     request_id_ctx.reset(token)
     return response
@@ -155,6 +206,12 @@ _init_tracing()
 AGENT_MODEL_CONTEXT_TOKENS = int(os.getenv("AGENT_MODEL_CONTEXT_TOKENS", "0"))
 ASSISTANT_MODEL_CONTEXT_TOKENS = int(os.getenv("ASSISTANT_MODEL_CONTEXT_TOKENS", "0"))
 PROMPT_PATH = os.getenv("AGENT_PROMPT_PATH", "/app/data/prompt.txt")
+OPENAI_CLIENT_CACHE_SIZE = int(os.getenv("AGENT_OPENAI_CLIENT_CACHE_SIZE", "32"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("AGENT_OPENAI_MAX_CONNECTIONS", "64"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("AGENT_OPENAI_MAX_KEEPALIVE", "32"))
+TOOL_CONCURRENCY = int(os.getenv("AGENT_TOOL_CONCURRENCY", "8"))
+READ_ONLY_TOOLS = {"get_state", "list_canvas_participants"}
+CRUD_TOOLS = {"layers", "node", "edge"}
 MODEL_CONTEXT_TOKENS = {
     "gpt-5.2": 400000,
 }
@@ -187,6 +244,8 @@ DEFAULT_PROMPT = "\n".join(DEFAULT_PROMPT_LINES)
 
 _prompt_cache: str | None = None
 _prompt_mtime: float | None = None
+_openai_clients: OrderedDict[tuple[str | None, float | None, str], AsyncOpenAI] = OrderedDict()
+_openai_http_client: httpx.AsyncClient | None = None
 
 
 class MCPConfig(BaseModel):
@@ -259,12 +318,34 @@ def _mask_secret(value: Any, keep: int = 4) -> str:
         return f"{raw[:1]}...{raw[-1:]}"
     return f"{raw[:keep]}...{raw[-keep:]}"
 
+def _get_field(item: Any, name: str) -> Any:
+    return item.get(name) if isinstance(item, dict) else getattr(item, name, None)
+
+def _field_getter(sample: Any, name: str) -> Callable[[Any], Any]:
+    # Output lists are homogeneous in practice (all dicts or all SDK models), so the
+    # accessor is picked once from the first item; mismatched items still resolve.
+    if isinstance(sample, dict):
+        def _get_key(item: Any) -> Any:
+            try:
+                return item[name]
+            except (KeyError, TypeError, IndexError):
+                return None if isinstance(item, dict) else getattr(item, name, None)
+        return _get_key
+
+    def _get_attr(item: Any) -> Any:
+        try:
+            return getattr(item, name)
+        except AttributeError:
+            return item.get(name) if isinstance(item, dict) else None
+    return _get_attr
+
 def _summarize_output_items(output: Any) -> dict[str, int]:
     counts: dict[str, int] = {}
-    if not isinstance(output, list):
+    if not isinstance(output, list) or not output:
         return counts
+    get_type = _field_getter(output[0], "type")
     for item in output:
-        item_type = item.get("type") if isinstance(item, dict) else getattr(item, "type", None)
+        item_type = get_type(item)
         label = item_type if isinstance(item_type, str) and item_type else "unknown"
         counts[label] = counts.get(label, 0) + 1
     return counts
@@ -356,23 +437,54 @@ def _build_instructions(user_name: str | None, extra: str | None) -> str:
         parts.append(extra.strip())
     return "\n".join(parts)
 
+def _dumps(value: Any) -> str:
+    try:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:
+        # orjson rejects integers wider than 64 bits; stdlib json still encodes them.
+        return json.dumps(value, ensure_ascii=False)
+
+def _loads(raw: str | bytes) -> Any:
+    return orjson.loads(raw)
+
 def _parse_tool_args(raw: Any) -> dict[str, Any]:
-    if not raw:
-        return {}
     if isinstance(raw, dict):
         return raw
+    if not raw or raw == "{}" or raw == "null":
+        return {}
     if isinstance(raw, str):
         try:
-            return json.loads(raw)
-        except json.JSONDecodeError:
+            parsed = _loads(raw)
+        except orjson.JSONDecodeError:
             return {}
+        return parsed if isinstance(parsed, dict) else {}
     return {}
 
 def _normalize_tool_schema(schema: Any) -> dict[str, Any]:
     if isinstance(schema, dict):
-        normalized = copy.deepcopy(schema)
+        try:
+            normalized = _loads(orjson.dumps(schema, option=orjson.OPT_NON_STR_KEYS))
+        except orjson.JSONEncodeError:
+            normalized = copy.deepcopy(schema)
     else:
         normalized = {}
+    return _fill_tool_schema(normalized)
+
+@functools.lru_cache(maxsize=256)
+def _normalize_tool_schema_json(raw: bytes) -> dict[str, Any]:
+    return _fill_tool_schema(_loads(raw))
+
+def _cached_tool_schema(schema: Any) -> dict[str, Any]:
+    # Shared across runs: callers must treat the returned schema as read-only.
+    if not isinstance(schema, dict):
+        return _normalize_tool_schema(schema)
+    try:
+        raw = orjson.dumps(schema, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        return _normalize_tool_schema(schema)
+    return _normalize_tool_schema_json(raw)
+
+def _fill_tool_schema(normalized: dict[str, Any]) -> dict[str, Any]:
     if normalized.get("type") is None:
         normalized["type"] = "object"
     if not isinstance(normalized.get("properties"), dict):
@@ -390,39 +502,30 @@ def _normalize_tool_schema(schema: Any) -> dict[str, Any]:
     normalized["additionalProperties"] = False
     return normalized
 
-def _serialize_tool_result(result: Any) -> str:
+def _tool_result_to_obj(result: Any) -> Any:
     if result is None:
-        return ""
+        return None
     structured = getattr(result, "structuredContent", None)
     if structured is not None:
-        return json.dumps(structured, ensure_ascii=False)
+        return structured
     content = getattr(result, "content", None)
     if isinstance(content, list):
-        payload = []
-        for block in content:
-            if hasattr(block, "model_dump"):
-                payload.append(block.model_dump())
-            else:
-                payload.append(block)
-        return json.dumps(payload, ensure_ascii=False)
-    return json.dumps(str(result), ensure_ascii=False)
+        return [block.model_dump() if hasattr(block, "model_dump") else block for block in content]
+    return str(result)
 
 def _extract_function_calls(output: Any) -> list[Any]:
-    calls: list[Any] = []
-    if not isinstance(output, list):
-        return calls
-    for item in output:
-        item_type = item.get("type") if isinstance(item, dict) else getattr(item, "type", None)
-        if item_type == "function_call":
-            calls.append(item)
-    return calls
+    if not isinstance(output, list) or not output:
+        return []
+    get_type = _field_getter(output[0], "type")
+    return [item for item in output if get_type(item) == "function_call"]
 
 def _extract_web_search_items(output: Any) -> list[dict[str, Any]]:
     items: list[dict[str, Any]] = []
-    if not isinstance(output, list):
+    if not isinstance(output, list) or not output:
         return items
+    get_type = _field_getter(output[0], "type")
     for item in output:
-        item_type = item.get("type") if isinstance(item, dict) else getattr(item, "type", None)
+        item_type = get_type(item)
         if not isinstance(item_type, str) or "web_search" not in item_type:
             continue
         if isinstance(item, dict):
@@ -435,18 +538,91 @@ def _extract_web_search_items(output: Any) -> list[dict[str, Any]]:
     return items
 
 def _tool_call_priority(call: Any) -> int:
-    name = call.get("name") if isinstance(call, dict) else getattr(call, "name", None)
-    args_raw = call.get("arguments") if isinstance(call, dict) else getattr(call, "arguments", None)
-    args = _parse_tool_args(args_raw)
+    name = _get_field(call, "name")
+    args = _parse_tool_args(_get_field(call, "arguments"))
     action = args.get("action") if isinstance(args, dict) else None
     if name == "edge" and action == "create":
         return 10
     return 0
 
-def _prioritize_tool_calls(calls: list[Any]) -> list[Any]:
-    indexed = list(enumerate(calls))
-    indexed.sort(key=lambda pair: (_tool_call_priority(pair[1]), pair[0]))
-    return [call for _, call in indexed]
+def _partition_tool_calls(calls: list[Any]) -> tuple[list[Any], list[Any]]:
+    # Only edge creation is deferred, so a stable two-bucket partition replaces the sort
+    # and only edge calls pay for argument parsing.
+    ordered: list[Any] = []
+    deferred: list[Any] = []
+    for call in calls:
+        if _get_field(call, "name") == "edge" and _tool_call_priority(call):
+            deferred.append(call)
+        else:
+            ordered.append(call)
+    return ordered, deferred
+
+def _call_fields(call: Any) -> tuple[Any, Any, Any]:
+    if isinstance(call, dict):
+        return call.get("call_id"), call.get("name"), call.get("arguments")
+    return getattr(call, "call_id", None), getattr(call, "name", None), getattr(call, "arguments", None)
+
+async def _invoke_tool_call(session: Any, call: Any, semaphore: asyncio.Semaphore) -> tuple[str, str, dict[str, Any], Any] | None:
+    call_id, name, args_raw = _call_fields(call)
+    if not call_id or not name:
+        return None
+    args = _parse_tool_args(args_raw)
+    async with semaphore:
+        result = await session.call_tool(name, args)
+    return call_id, name, args, result
+
+def _is_read_only_tool_call(call: Any) -> bool:
+    name = _get_field(call, "name")
+    if name in READ_ONLY_TOOLS:
+        return True
+    if name not in CRUD_TOOLS:
+        return False
+    args = _parse_tool_args(_get_field(call, "arguments"))
+    return isinstance(args, dict) and args.get("action") == "read"
+
+async def _invoke_tool_calls(session: Any, calls: list[Any], limit: int) -> list[tuple[str, str, dict[str, Any], Any] | None]:
+    # Only consecutive read-only calls run concurrently. Writes run one at a time in the
+    # model's order, and the first failure stops the turn, so no later write runs after
+    # it. Writes that already finished are not rolled back. Deferred edge creation runs
+    # after everything else, so the cards it links exist. Results keep the prioritized order.
+    semaphore = asyncio.Semaphore(max(limit, 1))
+    results: list[tuple[str, str, dict[str, Any], Any] | None] = []
+    reads: list[Any] = []
+
+    async def flush_reads() -> None:
+        if not reads:
+            return
+        batch_results = await asyncio.gather(
+            *(_invoke_tool_call(session, call, semaphore) for call in reads),
+            return_exceptions=True,
+        )
+        reads.clear()
+        for item in batch_results:
+            if isinstance(item, BaseException):
+                raise item
+        results.extend(batch_results)
+
+    ordered, deferred = _partition_tool_calls(calls)
+    for call in [*ordered, *deferred]:
+        if _is_read_only_tool_call(call):
+            reads.append(call)
+            continue
+        await flush_reads()
+        results.append(await _invoke_tool_call(session, call, semaphore))
+    await flush_reads()
+    return results
+
+def _openai_error_details(exc: APIStatusError) -> tuple[str | None, str]:
+    body = getattr(exc, "body", None)
+    if isinstance(body, (bytes, str)):
+        try:
+            body = _loads(body)
+        except orjson.JSONDecodeError:
+            body = None
+    match body:
+        case {"error": {**err}}:
+            return err.get("code") or err.get("type"), err.get("message") or str(exc)
+    return None, str(exc)
 
 @asynccontextmanager
 async def mcp_session_context(mcp_config: MCPConfig | None, timeout_s: float | None):
@@ -477,33 +653,46 @@ def _estimate_size(value: Any) -> int:
     if isinstance(value, str):
         return len(value)
     try:
-        return len(json.dumps(value, ensure_ascii=False))
+        return len(_dumps(value))
     except Exception:
         return len(str(value))
 
+class _LazyLogArg:
+    __slots__ = ("_func", "_args")
+
+    def __init__(self, func: Callable[..., Any], *args: Any) -> None:
+        self._func = func
+        self._args = args
+
+    def __str__(self) -> str:
+        return str(self._func(*self._args))
+
 def _safe_log_payload(value: Any, max_chars: int | None = None) -> str:
     limit = max_chars if isinstance(max_chars, int) and max_chars > 0 else LOG_TRUNCATE
     if isinstance(value, str):
         text = value
     else:
         try:
-            text = json.dumps(value, ensure_ascii=False)
+            text = _dumps(value)
         except Exception:
             text = str(value)
     if len(text) <= limit:
         return text
     return f"{text[:limit]}...(+{len(text) - limit} chars)"
 
+@functools.lru_cache(maxsize=64)
+def _canonical_model_name(model: str) -> str:
+    return model.strip().lower()
+
 def _normalize_model_name(model: str | None) -> str:
     if not isinstance(model, str):
         return ""
-    return model.strip().lower()
+    return _canonical_model_name(model)
 
-def _resolve_model_context_tokens(model: str | None) -> int:
+def _context_tokens_for(normalized: str) -> int:
     override = AGENT_MODEL_CONTEXT_TOKENS or ASSISTANT_MODEL_CONTEXT_TOKENS
     if isinstance(override, int) and override > 0:
         return override
-    normalized = _normalize_model_name(model)
     if not normalized:
         return 0
     if normalized in MODEL_CONTEXT_TOKENS:
@@ -512,11 +701,11 @@ def _resolve_model_context_tokens(model: str | None) -> int:
         return MODEL_CONTEXT_TOKENS.get("gpt-5.2", 0)
     return 0
 
-def _get_encoder(model: str | None):
-    normalized = _normalize_model_name(model)
-    if normalized:
+@functools.lru_cache(maxsize=16)
+def _cached_encoder(normalized_name: str):
+    if normalized_name:
         try:
-            return tiktoken.encoding_for_model(normalized)
+            return tiktoken.encoding_for_model(normalized_name)
         except KeyError:
             pass
     try:
@@ -524,116 +713,117 @@ def _get_encoder(model: str | None):
     except KeyError:
         return tiktoken.get_encoding("cl100k_base")
 
-def _count_tokens(text: str | None, model: str | None) -> int:
+def _get_encoder(model: str | None):
+    return _cached_encoder(_normalize_model_name(model))
+
+def _resolve_encoder(model: str | None) -> Any:
+    # None makes the counting helpers fall back to the ~4 chars/token estimate.
+    try:
+        return _get_encoder(model)
+    except Exception:
+        return None
+
+def _count_tokens_with(encoder: Any, text: str | None) -> int:
     if not isinstance(text, str) or not text:
         return 0
     try:
-        encoder = _get_encoder(model)
         return len(encoder.encode(text))
     except Exception:
         return max(1, len(text) // 4)
 
-def _stringify_payload(value: Any) -> str:
-    if isinstance(value, str):
-        return value
+def _count_tokens_batch(encoder: Any, chunks: list[str]) -> int:
+    texts = [chunk for chunk in chunks if isinstance(chunk, str) and chunk]
+    if not texts:
+        return 0
     try:
-        return json.dumps(value, ensure_ascii=False)
+        return sum(len(ids) for ids in encoder.encode_batch(texts))
     except Exception:
-        return str(value)
+        return sum(_count_tokens_with(encoder, text) for text in texts)
+
+def _count_tokens(text: str | None, model: str | None) -> int:
+    if not isinstance(text, str) or not text:
+        return 0
+    return _count_tokens_with(_resolve_encoder(model), text)
 
 def _extract_text_chunks(value: Any) -> list[str]:
     if value is None:
         return []
     if isinstance(value, str):
         return [value]
-    if isinstance(value, list):
-        chunks: list[str] = []
-        for item in value:
-            if isinstance(item, str):
-                chunks.append(item)
-                continue
-            if isinstance(item, dict):
-                content = item.get("content")
-                if isinstance(content, str):
-                    chunks.append(content)
-                    continue
-                if isinstance(content, list):
-                    for part in content:
-                        if isinstance(part, str):
-                            chunks.append(part)
-                        elif isinstance(part, dict):
-                            text = part.get("text")
-                            if isinstance(text, str):
-                                chunks.append(text)
-                            else:
-                                chunks.append(_stringify_payload(part))
-                        else:
-                            chunks.append(_stringify_payload(part))
-                    continue
-            chunks.append(_stringify_payload(item))
-        return chunks
     if isinstance(value, dict):
-        content = value.get("content")
-        if isinstance(content, str):
-            return [content]
-        if isinstance(content, list):
-            chunks = []
-            for part in content:
-                if isinstance(part, str):
-                    chunks.append(part)
-                elif isinstance(part, dict):
-                    text = part.get("text")
-                    if isinstance(text, str):
-                        chunks.append(text)
-                    else:
-                        chunks.append(_stringify_payload(part))
-                else:
-                    chunks.append(_stringify_payload(part))
-            return chunks
-        return [_stringify_payload(value)]
-    return [str(value)]
-
-def _calculate_context(model: str | None, instructions: str | None, input_value: Any, extra_chunks: list[str] | None = None) -> dict[str, Any]:
-    chunks = []
+        items: list[Any] = [value]
+    elif isinstance(value, list):
+        items = value
+    else:
+        return [str(value)]
+    # Non-text parts are counted as _dumps renders them, the same encoding used when sending.
+    chunks: list[str] = []
+    append = chunks.append
+    for item in items:
+        if isinstance(item, str):
+            append(item)
+            continue
+        if isinstance(item, dict):
+            content = item.get("content")
+            if isinstance(content, str):
+                append(content)
+                continue
+            if isinstance(content, list):
+                for part in content:
+                    if isinstance(part, str):
+                        append(part)
+                        continue
+                    if isinstance(part, dict):
+                        text = part.get("text")
+                        if isinstance(text, str):
+                            append(text)
+                            continue
+                    try:
+                        append(_dumps(part))
+                    except TypeError:
+                        append(str(part))
+                continue
+        try:
+            append(_dumps(item))
+        except TypeError:
+            append(str(item))
+    return chunks
+
+def _calculate_context(model: str | None, instructions: str | None, input_value: Any, extra_chunks: Iterable[str] | None = None) -> dict[str, Any]:
+    normalized = _normalize_model_name(model)
+    max_tokens = _context_tokens_for(normalized)
+    if not max_tokens:
+        return _context_from_tokens(0, 0)
+    # Order is irrelevant to the token sum, so everything is appended to the fresh list
+    # from _extract_text_chunks; empty and non-string chunks are dropped by the counter.
+    chunks = _extract_text_chunks(input_value)
     if isinstance(instructions, str) and instructions.strip():
         chunks.append(instructions)
-    chunks.extend(_extract_text_chunks(input_value))
-    if extra_chunks:
-        for chunk in extra_chunks:
-            if isinstance(chunk, str) and chunk:
-                chunks.append(chunk)
-    used_tokens = sum(_count_tokens(chunk, model) for chunk in chunks)
-    max_tokens = _resolve_model_context_tokens(model)
-    remaining = max(max_tokens - used_tokens, 0) if max_tokens else 0
-    remaining_ratio = remaining / max_tokens if max_tokens else 0
+    if extra_chunks is not None:
+        chunks.extend(extra_chunks)
+    return _context_from_tokens(max_tokens, _count_tokens_batch(_resolve_encoder(normalized), chunks))
+
+def _extend_context(context: dict[str, Any], encoder: Any, new_chunk: str | None) -> dict[str, Any]:
+    # Adds only the new chunk's tokens to a previous result, so per-turn accounting never
+    # re-tokenizes the instructions, input or earlier chunks.
+    max_tokens = context["maxTokens"]
+    if not max_tokens or not new_chunk:
+        return context
+    return _context_from_tokens(max_tokens, context["usedTokens"] + _count_tokens_with(encoder, new_chunk))
+
+def _context_from_tokens(max_tokens: int, used_tokens: int) -> dict[str, Any]:
+    if not max_tokens:
+        used_tokens = 0
+    remaining = max(max_tokens - used_tokens, 0)
     return {
         "maxTokens": max_tokens,
         "usedTokens": used_tokens,
         "remainingTokens": remaining,
-        "remainingRatio": remaining_ratio,
+        "remainingRatio": remaining / max_tokens if max_tokens else 0,
     }
 
 
-@app.get("/health")
-async def health() -> dict[str, str]:
-    return {"status": "ok"}
-
-@app.get("/prompt", response_model=PromptResponse)
-async def get_prompt() -> PromptResponse:
-    return PromptResponse(prompt=_load_prompt_text())
-
-@app.post("/prompt", response_model=PromptResponse)
-async def update_prompt(req: PromptUpdateRequest) -> PromptResponse:
-    try:
-        prompt = _save_prompt_text(req.prompt)
-    except ValueError as exc:
-        raise HTTPException(status_code=400, detail=str(exc)) from exc
-    return PromptResponse(prompt=prompt)
-
-@app.get("/prompt/ui", response_class=HTMLResponse)
-async def prompt_ui() -> HTMLResponse:
-    prompt = html.escape(_load_prompt_text())
-    page = f"""
+PROMPT_UI_TEMPLATE = """
 <!doctype html>
 <html lang="en">
 <head>
@@ -641,37 +831,37 @@ async def prompt_ui() -> HTMLResponse:
   <meta name="viewport" content="width=device-width, initial-scale=1" />
   <title>Raven Prompt Editor</title>
   <style>
-    :root {{
+    :root {
       color-scheme: light;
-    }}
-    body {{
+    }
+    body {
       margin: 0;
       font-family: "IBM Plex Sans", "SF Pro Text", "Segoe UI", sans-serif;
       background: linear-gradient(135deg, #eef2f7, #f7f5f2);
       color: #1b1f2a;
-    }}
-    .wrap {{
+    }
+    .wrap {
       max-width: 920px;
       margin: 48px auto;
       padding: 0 20px 40px;
-    }}
-    .card {{
+    }
+    .card {
       background: #ffffff;
       border-radius: 18px;
       box-shadow: 0 24px 60px rgba(15, 23, 42, 0.12);
       border: 1px solid #e1e6ef;
       padding: 28px;
-    }}
-    h1 {{
+    }
+    h1 {
       font-size: 22px;
       margin: 0 0 6px;
       letter-spacing: -0.01em;
-    }}
-    p {{
+    }
+    p {
       margin: 0 0 18px;
       color: #4c5566;
-    }}
-    textarea {{
+    }
+    textarea {
       width: 100%;
       min-height: 320px;
       resize: vertical;
@@ -684,15 +874,15 @@ async def prompt_ui() -> HTMLResponse:
       box-sizing: border-box;
       background: #f9fafc;
       color: #0f172a;
-    }}
-    .row {{
+    }
+    .row {
       display: flex;
       align-items: center;
       justify-content: space-between;
       gap: 12px;
       margin-top: 18px;
-    }}
-    button {{
+    }
+    button {
       border: none;
       border-radius: 12px;
       padding: 10px 18px;
@@ -701,15 +891,15 @@ async def prompt_ui() -> HTMLResponse:
       cursor: pointer;
       background: #111827;
       color: #ffffff;
-    }}
-    button[disabled] {{
+    }
+    button[disabled] {
       opacity: 0.6;
       cursor: not-allowed;
-    }}
-    .status {{
+    }
+    .status {
       font-size: 13px;
       color: #64748b;
-    }}
+    }
   </style>
 </head>
 <body>
@@ -717,7 +907,7 @@ async def prompt_ui() -> HTMLResponse:
     <div class="card">
       <h1>Raven Prompt Editor</h1>
       <p>Edit the system prompt used by the agent service.</p>
-      <textarea id="prompt">{prompt}</textarea>
+      <textarea id="prompt">{{PROMPT}}</textarea>
       <div class="row">
         <span class="status" id="status">Ready.</span>
         <button id="save">Save</button>
@@ -729,44 +919,109 @@ async def prompt_ui() -> HTMLResponse:
     const saveBtn = document.getElementById('save');
     const promptEl = document.getElementById('prompt');
 
-    const setStatus = (text) => {{
+    const setStatus = (text) => {
       statusEl.textContent = text;
-    }};
+    };
 
-    saveBtn.addEventListener('click', async () => {{
+    saveBtn.addEventListener('click', async () => {
       const text = promptEl.value || '';
-      if (!text.trim()) {{
+      if (!text.trim()) {
         setStatus('Prompt cannot be empty.');
         return;
-      }}
+      }
       saveBtn.disabled = true;
       setStatus('Saving...');
-      try {{
-        const res = await fetch('/prompt', {{
+      try {
+        const res = await fetch('/prompt', {
           method: 'POST',
-          headers: {{ 'content-type': 'application/json' }},
-          body: JSON.stringify({{ prompt: text }}),
-        }});
-        const body = await res.json().catch(() => ({{}}));
-        if (!res.ok) {{
+          headers: { 'content-type': 'application/json' },
+          body: JSON.stringify({ prompt: text }),
+        });
+        const body = await res.json().catch(() => ({}));
+        if (!res.ok) {
           setStatus(body?.detail || 'Save failed.');
           return;
-        }}
+        }
         setStatus('Saved.');
-      }} catch (err) {{
+      } catch (err) {
         setStatus('Save failed.');
-      }} finally {{
+      } finally {
         saveBtn.disabled = false;
-      }}
-    }});
+      }
+    });
   </script>
 </body>
 </html>
 """
-    return HTMLResponse(content=page)
+_PROMPT_UI_PREFIX, _PROMPT_UI_SUFFIX = (part.encode("utf-8") for part in PROMPT_UI_TEMPLATE.split("{{PROMPT}}", 1))
+_prompt_ui_cache: tuple[str, bytes] | None = None
+
+
+def _get_openai_http_client() -> httpx.AsyncClient:
+    global _openai_http_client
+    if _openai_http_client is None or _openai_http_client.is_closed:
+        _openai_clients.clear()
+        _openai_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            ),
+        )
+    return _openai_http_client
+
+def _get_openai_client(api_key: str, base_url: str | None, timeout: float | None) -> AsyncOpenAI:
+    http_client = _get_openai_http_client()
+    key = (base_url or None, timeout, hashlib.sha256(api_key.encode("utf-8")).hexdigest())
+    client = _openai_clients.get(key)
+    if client is not None:
+        _openai_clients.move_to_end(key)
+        return client
+    # Connections live in the shared http_client, so an evicted client holds nothing to close
+    # and requests still running on it are not cut off.
+    client = AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url or None,
+        timeout=timeout,
+        http_client=http_client,
+    )
+    _openai_clients[key] = client
+    while len(_openai_clients) > max(OPENAI_CLIENT_CACHE_SIZE, 1):
+        _openai_clients.popitem(last=False)
+    return client
+
+async def _close_openai_clients() -> None:
+    _openai_clients.clear()
+    if _openai_http_client:
+        await _openai_http_client.aclose()
+
+
+@app.get("/health")
+async def health() -> dict[str, str]:
+    return {"status": "ok"}
+
+@app.get("/prompt", response_model=PromptResponse)
+def get_prompt() -> PromptResponse:
+    return PromptResponse(prompt=_load_prompt_text())
+
+@app.post("/prompt", response_model=PromptResponse)
+def update_prompt(req: PromptUpdateRequest) -> PromptResponse:
+    try:
+        prompt = _save_prompt_text(req.prompt)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return PromptResponse(prompt=prompt)
+
+@app.get("/prompt/ui", response_class=HTMLResponse)
+def prompt_ui() -> Response:
+    global _prompt_ui_cache
+    prompt = _load_prompt_text()
+    if _prompt_ui_cache is None or _prompt_ui_cache[0] != prompt:
+        body = _PROMPT_UI_PREFIX + html.escape(prompt).encode("utf-8") + _PROMPT_UI_SUFFIX
+        _prompt_ui_cache = (prompt, body)
+    return Response(content=_prompt_ui_cache[1], media_type="text/html; charset=utf-8")
 
 @app.post("/context", response_model=AgentContextResponse)
-async def get_context(req: AgentContextRequest) -> AgentContextResponse:
+def get_context(req: AgentContextRequest) -> AgentContextResponse:
     instructions = _build_instructions(req.userName, req.instructions)
     context = _calculate_context(req.model, instructions, req.input)
     return AgentContextResponse(context=context)
@@ -777,18 +1032,18 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
     if not req.apiKey or not req.apiKey.strip():
         raise HTTPException(status_code=400, detail="openai_key_required")
 
-    run_id = str(uuid.uuid4())
-    started = time.monotonic()
-    input_size = _estimate_size(req.input)
+    run_id = uuid.uuid4().hex
+    debug_on = logger.isEnabledFor(logging.DEBUG)
+    started = time.perf_counter_ns()
     logger.info(
         "run_start id=%s model=%s maxTurns=%s inputSize=%s mcp=%s",
         run_id,
         req.model,
         req.maxTurns,
-        input_size,
+        _LazyLogArg(_estimate_size, req.input),
         "yes" if (req.mcp and req.mcp.url) else "no",
     )
-    if logger.isEnabledFor(logging.DEBUG):
+    if debug_on:
         logger.debug(
             "run_context id=%s apiKey=%s baseUrl=%s timeoutMs=%s temperature=%s",
             run_id,
@@ -797,17 +1052,13 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
             req.openaiTimeoutMs,
             req.temperature,
         )
-        logger.debug("run_input id=%s payload=%s", run_id, _safe_log_payload(req.input))
+        logger.debug("run_input id=%s payload=%s", run_id, _LazyLogArg(_safe_log_payload, req.input))
 
     timeout = None
     if isinstance(req.openaiTimeoutMs, int) and req.openaiTimeoutMs > 0:
         timeout = req.openaiTimeoutMs / 1000
 
-    client = AsyncOpenAI(
-        api_key=req.apiKey,
-        base_url=req.openaiBaseUrl or None,
-        timeout=timeout,
-    )
+    client = _get_openai_client(req.apiKey, req.openaiBaseUrl, timeout)
 
     allowed = []
     if req.mcp and req.mcp.allowedTools:
@@ -821,7 +1072,7 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
             req.mcp.sessionId,
             len(allowed),
         )
-        if logger.isEnabledFor(logging.DEBUG):
+        if debug_on:
             logger.debug(
                 "mcp_details id=%s token=%s allowed=%s",
                 run_id,
@@ -829,7 +1080,7 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
                 allowed,
             )
 
-    instructions = _build_instructions(req.userName, req.instructions)
+    instructions = await run_in_threadpool(_build_instructions, req.userName, req.instructions)
     if req.webSearchEnabled:
         instructions = "\n\n".join([
             instructions,
@@ -857,7 +1108,7 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
                             "type": "function",
                             "name": name,
                             "description": getattr(tool, "description", None),
-                            "parameters": _normalize_tool_schema(getattr(tool, "inputSchema", None)),
+                            "parameters": _cached_tool_schema(getattr(tool, "inputSchema", None)),
                             "strict": False,
                         }
                     )
@@ -871,16 +1122,17 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
             web_search_tools = [{"type": "web_search"}] if req.webSearchEnabled else []
             tools_payload = function_tools + web_search_tools
             tools_enabled = bool(tools_payload)
+            # Built once per run; each turn only swaps input and previous_response_id.
             parse_kwargs: dict[str, Any] = {
                 "model": req.model,
                 "instructions": instructions,
-                "input": req.input,
                 "temperature": req.temperature,
                 "tools": tools_payload if tools_enabled else None,
                 "parallel_tool_calls": tools_enabled,
                 "text_format": AssistantResponse,
+                "input": req.input,
             }
-            if logger.isEnabledFor(logging.DEBUG):
+            if debug_on:
                 logger.debug(
                     "openai_request id=%s toolCount=%s",
                     run_id,
@@ -888,38 +1140,33 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
                 )
             response = await client.responses.parse(**parse_kwargs)
 
-            tool_output_chunks: list[str] = []
-            last_context = _calculate_context(req.model, instructions, req.input)
+            # Instructions and input are tokenized once; each turn only adds its own chunks.
+            context = _calculate_context(req.model, instructions, req.input)
+            token_encoder = _resolve_encoder(req.model) if context["maxTokens"] else None
 
             while mcp_session:
-                tool_calls = _prioritize_tool_calls(_extract_function_calls(getattr(response, "output", None)))
+                tool_calls = _extract_function_calls(getattr(response, "output", None))
                 if not tool_calls:
                     break
 
                 outputs = []
-                for call in tool_calls:
-                    call_id = call.get("call_id") if isinstance(call, dict) else getattr(call, "call_id", None)
-                    name = call.get("name") if isinstance(call, dict) else getattr(call, "name", None)
-                    args_raw = call.get("arguments") if isinstance(call, dict) else getattr(call, "arguments", None)
-                    if not call_id or not name:
+                for invoked in await _invoke_tool_calls(mcp_session, tool_calls, TOOL_CONCURRENCY):
+                    if invoked is None:
                         continue
-                    args = _parse_tool_args(args_raw)
-                    result = await mcp_session.call_tool(name, args)
+                    call_id, name, args, result = invoked
                     payload = {
                         "isError": bool(getattr(result, "isError", False)),
-                        "content": json.loads(_serialize_tool_result(result) or "null"),
+                        "content": _tool_result_to_obj(result),
                     }
+                    serialized = _dumps(payload)
                     outputs.append(
                         {
                             "type": "function_call_output",
                             "call_id": call_id,
-                            "output": json.dumps(payload, ensure_ascii=False),
+                            "output": serialized,
                         }
                     )
-                    serialized = _serialize_tool_result(result)
-                    if serialized:
-                        tool_output_chunks.append(serialized)
-                        last_context = _calculate_context(req.model, req.instructions, req.input, tool_output_chunks)
+                    context = _extend_context(context, token_encoder, serialized)
                     trace_entry = {
                         "name": name,
                         "callId": call_id,
@@ -928,30 +1175,24 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
                         "isError": payload["isError"],
                     }
                     tool_trace.append(trace_entry)
-                    if logger.isEnabledFor(logging.DEBUG):
+                    if debug_on:
                         logger.debug(
                             "tool_call id=%s name=%s args=%s error=%s",
                             run_id,
                             name,
-                            _safe_log_payload(args),
+                            _LazyLogArg(_safe_log_payload, args),
                             payload["isError"],
                         )
 
                 if not outputs:
                     break
 
-                parse_kwargs = {
-                    "model": req.model,
-                    "instructions": instructions,
-                    "input": outputs,
-                    "temperature": req.temperature,
-                    "tools": tools_payload if tools_enabled else None,
-                    "parallel_tool_calls": tools_enabled,
-                    "text_format": AssistantResponse,
-                    "previous_response_id": getattr(response, "id", None),
-                }
+                parse_kwargs["input"] = outputs
+                parse_kwargs["previous_response_id"] = getattr(response, "id", None)
                 response = await client.responses.parse(**parse_kwargs)
 
+            response_id = getattr(response, "id", None)
+            response_output = getattr(response, "output", None)
             parsed = getattr(response, "output_parsed", None)
             output = ""
             reasoning = None
@@ -965,28 +1206,25 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
             output = _format_output(output).strip()
             if isinstance(reasoning, str):
                 reasoning = reasoning.strip() or None
-            elapsed = int((time.monotonic() - started) * 1000)
+            elapsed = (time.perf_counter_ns() - started) // 1_000_000
             logger.info(
                 "run_done id=%s ms=%s outputSize=%s lastResponseId=%s",
                 run_id,
                 elapsed,
                 len(output),
-                getattr(response, "id", None),
+                response_id,
             )
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("run_output id=%s payload=%s", run_id, _safe_log_payload(output))
+            if debug_on:
+                logger.debug("run_output id=%s payload=%s", run_id, _LazyLogArg(_safe_log_payload, output))
                 logger.debug(
                     "openai_response id=%s usage=%s outputTypes=%s",
                     run_id,
-                    _safe_log_payload(getattr(response, "usage", None)),
-                    _summarize_output_items(getattr(response, "output", None)),
+                    _LazyLogArg(_safe_log_payload, getattr(response, "usage", None)),
+                    _summarize_output_items(response_output),
                 )
-            extra_chunks = tool_output_chunks[:]
-            if output:
-                extra_chunks.append(output)
-            context = _calculate_context(req.model, instructions, req.input, extra_chunks) if extra_chunks else last_context
+            context = _extend_context(context, token_encoder, output)
             if req.webSearchEnabled:
-                web_search_items = _extract_web_search_items(getattr(response, "output", None))
+                web_search_items = _extract_web_search_items(response_output)
                 for _item in web_search_items:
                     tool_trace.append({"name": "web_search"})
             trace = None
@@ -997,19 +1235,13 @@ async def run_agent(req: AgentRunRequest) -> AgentRunResponse:
                 }
             return AgentRunResponse(
                 output=output,
-                lastResponseId=getattr(response, "id", None),
+                lastResponseId=response_id,
                 context=context,
                 trace=trace,
             )
     except APIStatusError as exc:
-        code = None
-        message = str(exc)
-        if isinstance(exc.body, dict):
-            err = exc.body.get("error") or {}
-            if isinstance(err, dict):
-                code = err.get("code") or err.get("type")
-                message = err.get("message") or message
-        elapsed = int((time.monotonic() - started) * 1000)
+        code, message = _openai_error_details(exc)
+        elapsed = (time.perf_counter_ns() - started) // 1_000_000
         logger.error(
             "run_error id=%s ms=%s status=%s code=%s message=%s",
             run_id,
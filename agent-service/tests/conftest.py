@@ -0,0 +1,73 @@
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+import pytest_asyncio
+
+
+APP_PATH = Path(__file__).resolve().parents[1] / "app.py"
+
+
+def load_app_module():
+    os.environ.setdefault("AGENT_LOG_LEVEL", "DEBUG")
+    os.environ.setdefault("AGENT_LOG_TRUNCATE", "2000")
+    app_dir = str(APP_PATH.parent)
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    module = importlib.import_module("app")
+    module.logger.setLevel(10)
+    return module
+
+
+class FastEncoder:
+    def encode(self, text):
+        return [0] * len(text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+
+@pytest.fixture(scope="session")
+def monkeypatch_session():
+    with pytest.MonkeyPatch.context() as patcher:
+        yield patcher
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _prompt_env(tmp_path_factory, monkeypatch_session):
+    prompt_dir = tmp_path_factory.mktemp("agent-prompt")
+    monkeypatch_session.setenv("AGENT_PROMPT_PATH", str(prompt_dir / "prompt.txt"))
+
+
+@pytest.fixture(scope="session")
+def app_mod(_prompt_env):
+    return load_app_module()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _warm_tiktoken(app_mod):
+    app_mod._resolve_encoder("gpt-5.2")
+
+
+@pytest.fixture(scope="session")
+def original_prompt(app_mod):
+    prompt = app_mod._load_prompt_text()
+    yield prompt
+    app_mod._save_prompt_text(prompt)
+
+
+@pytest.fixture
+def fast_encoder(app_mod, monkeypatch):
+    encoder = FastEncoder()
+    monkeypatch.setattr(app_mod, "_get_encoder", lambda _model: encoder)
+    return encoder
+
+
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def client(app_mod):
+    transport = httpx.ASGITransport(app=app_mod.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as shared:
+        yield shared
@@ -1,37 +1,33 @@
-import os
+import asyncio
 import types
 import httpx
 import json
-import importlib.util
 import sys
-import tempfile
 import builtins
 from contextlib import asynccontextmanager
-from pathlib import Path
+from dataclasses import dataclass
 
 import pytest
-from openai import APIStatusError
 
 
-APP_PATH = Path(__file__).resolve().parents[1] / "app.py"
-PROMPT_DIR = Path(tempfile.mkdtemp(prefix="agent-prompt-"))
-PROMPT_PATH = PROMPT_DIR / "prompt.txt"
-os.environ["AGENT_PROMPT_PATH"] = str(PROMPT_PATH)
+BODY_BASIC = json.dumps({
+    "apiKey": "sk-test",
+    "model": "gpt-5.2",
+    "instructions": "hi",
+    "input": "hello",
+}).encode()
+JSON_HEADERS = {"content-type": "application/json"}
 
 
-def load_app_module():
-    os.environ.setdefault("AGENT_LOG_LEVEL", "DEBUG")
-    os.environ.setdefault("AGENT_LOG_TRUNCATE", "2000")
-    spec = importlib.util.spec_from_file_location("agent_app", APP_PATH)
-    module = importlib.util.module_from_spec(spec)
-    assert spec and spec.loader
-    sys.modules["agent_app"] = module
-    spec.loader.exec_module(module)
-    module.logger.setLevel(10)
-    return module
+def _raise_os_boom(*_args, **_kwargs):
+    raise OSError("boom")
 
 
-app_mod = load_app_module()
+@dataclass(slots=True)
+class FakeToolResult:
+    structuredContent: object = None
+    content: object = None
+    isError: bool = False
 
 
 class FakeResponse:
@@ -72,137 +68,261 @@ class FakeTool:
         self.inputSchema = input_schema or {"type": "object", "properties": {}}
 
 
+NODE_TOOL = FakeTool("node", "create node")
+
+
 class FakeSession:
     def __init__(self):
         self.calls = []
 
     async def call_tool(self, name, args):
         self.calls.append((name, args))
-        return types.SimpleNamespace(isError=False, structuredContent={"ok": True, "args": args})
+        return FakeToolResult(structuredContent={"ok": True, "args": args})
+
+
+@pytest.fixture(autouse=True)
+def reset_openai_clients(app_mod):
+    app_mod._openai_clients.clear()
+    yield
+    app_mod._openai_clients.clear()
+
+
+@pytest.fixture
+def fake_openai(app_mod, monkeypatch):
+    def _install(*, result=None, results=None, error=None, capture=None):
+        monkeypatch.setattr(
+            app_mod,
+            "AsyncOpenAI",
+            lambda **kwargs: FakeClient(result=result, results=results, error=error, capture=capture, **kwargs),
+        )
+
+    return _install
+
+
+@pytest.fixture
+def prompt_state(app_mod):
+    original = (app_mod.PROMPT_PATH, app_mod._prompt_cache, app_mod._prompt_mtime)
+    app_mod._prompt_cache = None
+    app_mod._prompt_mtime = None
+    yield
+    app_mod.PROMPT_PATH, app_mod._prompt_cache, app_mod._prompt_mtime = original
 
 
 @pytest.fixture
-def fake_mcp_context():
+def fake_session():
+    return FakeSession()
+
+
+@pytest.fixture
+def fake_mcp_context(fake_session):
     @asynccontextmanager
     async def _ctx(_config, _timeout):
-        yield FakeSession(), [FakeTool("node", "create node")]
+        yield fake_session, [NODE_TOOL]
 
     return _ctx
 
+
 @pytest.mark.asyncio
-async def test_health():
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.get("/health")
+async def test_health(client):
+    resp = await client.get("/health")
     assert resp.status_code == 200
-    assert resp.json() == {"status": "ok"}
+    assert resp.content == b'{"status":"ok"}'
 
 
 @pytest.mark.asyncio
-async def test_run_missing_key():
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": " ",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-        })
+async def test_metrics_use_route_template_labels(app_mod, client):
+    await client.get("/health")
+    await client.get("/missing/abc-123")
+    labels = {
+        sample.labels.get("path")
+        for metric in app_mod.REQUEST_COUNT.collect()
+        for sample in metric.samples
+    }
+    assert "/health" in labels
+    assert "unknown" in labels
+    assert "/missing/abc-123" not in labels
+
+
+@pytest.mark.asyncio
+async def test_run_missing_key(client):
+    resp = await client.post("/run", json={
+        "apiKey": " ",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+    })
     assert resp.status_code == 400
     assert resp.json()["detail"] == "openai_key_required"
 
 
-def test_helpers_cover_branches():
-    assert app_mod._format_output("ok") == "ok"
-    assert app_mod._format_output(123) == "123"
-    assert app_mod._format_output(None) == ""
+class TypedItem:
+    def __init__(self, t):
+        self.type = t
 
-    assert app_mod._mask_secret("") == ""
-    assert app_mod._mask_secret("abcd", keep=2) == "a...d"
-    assert app_mod._mask_secret("0123456789", keep=2) == "01...89"
 
-    assert app_mod._summarize_output_items("bad") == {}
-    assert app_mod._summarize_output_items([{ "type": "mcp_call" }, { "type": "mcp_call" }]) == {"mcp_call": 2}
+class Block:
+    def model_dump(self):
+        return {"text": "hi"}
 
-    assert app_mod._normalize_tool_schema(None) == {
-        "type": "object",
-        "properties": {},
-        "additionalProperties": False,
-    }
-    assert app_mod._normalize_tool_schema({"type": "object", "properties": [], "additionalProperties": True}) == {
-        "type": "object",
-        "properties": {},
-        "additionalProperties": False,
-    }
+
+@pytest.mark.parametrize("value, expected", [("ok", "ok"), (123, "123"), (None, "")])
+def test_format_output(app_mod, value, expected):
+    assert app_mod._format_output(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value, keep, expected",
+    [("", 4, ""), ("abcd", 2, "a...d"), ("0123456789", 2, "01...89")],
+)
+def test_mask_secret(app_mod, value, keep, expected):
+    assert app_mod._mask_secret(value, keep=keep) == expected
+
+
+@pytest.mark.parametrize(
+    "items, expected",
+    [
+        ("bad", {}),
+        ([{"type": "mcp_call"}, {"type": "mcp_call"}], {"mcp_call": 2}),
+        ([TypedItem("foo"), TypedItem(None)], {"foo": 1, "unknown": 1}),
+        ([TypedItem("foo"), {"type": "bar"}, object()], {"foo": 1, "bar": 1, "unknown": 1}),
+    ],
+)
+def test_summarize_output_items(app_mod, items, expected):
+    assert app_mod._summarize_output_items(items) == expected
+
+
+def test_normalize_tool_schema(app_mod):
+    closed_object = {"type": "object", "properties": {}, "additionalProperties": False}
+    assert app_mod._normalize_tool_schema(None) == closed_object
+    assert app_mod._normalize_tool_schema({"type": "object", "properties": [], "additionalProperties": True}) == closed_object
     patch_schema = app_mod._normalize_tool_schema({"properties": {"patch": {}}})["properties"]["patch"]
     assert patch_schema["type"] == "object"
     assert patch_schema["additionalProperties"] is False
     assert app_mod._normalize_tool_schema({"properties": {"id": "raw"}})["properties"]["id"]["type"] == "string"
+    source_schema = {"properties": {"patch": {"type": "object"}}}
+    app_mod._normalize_tool_schema(source_schema)
+    assert source_schema == {"properties": {"patch": {"type": "object"}}}
+    assert app_mod._normalize_tool_schema({"properties": {"tags": {"enum": {1, 2}}}})["properties"]["tags"]["enum"] == {1, 2}
 
-    class Obj:
-        def __init__(self, t):
-            self.type = t
 
-    assert app_mod._summarize_output_items([Obj("foo"), Obj(None)]) == {"foo": 1, "unknown": 1}
+def test_cached_tool_schema(app_mod):
+    cached = app_mod._cached_tool_schema({"properties": {"patch": {}}})
+    assert cached is app_mod._cached_tool_schema({"properties": {"patch": {}}})
+    assert cached["properties"]["patch"]["additionalProperties"] is False
+    assert app_mod._cached_tool_schema(None) == app_mod._normalize_tool_schema(None)
+    assert app_mod._cached_tool_schema({"properties": {"tags": {"enum": {1}}}})["properties"]["tags"]["enum"] == {1}
 
-    assert app_mod._estimate_size(None) == 0
-    assert app_mod._estimate_size("abc") == 3
-    assert app_mod._estimate_size({"a": 1}) > 0
-    assert app_mod._estimate_size({"bad": set([1, 2])}) == len(str({"bad": set([1, 2])}))
 
-    assert app_mod._safe_log_payload("short", max_chars=10) == "short"
-    assert "..." in app_mod._safe_log_payload("x" * 20, max_chars=10)
-    assert app_mod._safe_log_payload({"a": "b"}, max_chars=10).startswith("{")
-    assert "..." in app_mod._safe_log_payload({"bad": set([1, 2])}, max_chars=10)
+def test_extract_function_calls(app_mod):
+    mixed = [{"type": "function_call"}, TypedItem("function_call"), {"name": "x"}, "raw"]
+    assert app_mod._extract_function_calls(mixed) == mixed[:2]
+    assert len(app_mod._extract_function_calls([{"type": "function_call", "name": "x"}])) == 1
+    assert app_mod._extract_function_calls("bad") == []
+    assert app_mod._extract_web_search_items([]) == []
 
-    assert app_mod._parse_tool_args("") == {}
-    assert app_mod._parse_tool_args({"a": 1}) == {"a": 1}
-    assert app_mod._parse_tool_args("{\"a\": 2}") == {"a": 2}
-    assert app_mod._parse_tool_args("bad") == {}
-    assert app_mod._parse_tool_args(123) == {}
 
-    result = types.SimpleNamespace(structuredContent={"ok": True}, content=[{"text": "skip"}])
-    assert json.loads(app_mod._serialize_tool_result(result)) == {"ok": True}
+@pytest.mark.parametrize(
+    "value, expected",
+    [(None, 0), ("abc", 3), ({"bad": {1, 2}}, len(str({"bad": {1, 2}})))],
+)
+def test_estimate_size(app_mod, value, expected):
+    assert app_mod._estimate_size(value) == expected
 
-    class Block:
-        def model_dump(self):
-            return {"text": "hi"}
 
-    result = types.SimpleNamespace(structuredContent=None, content=[Block()])
-    assert json.loads(app_mod._serialize_tool_result(result)) == [{"text": "hi"}]
+def test_estimate_size_of_json(app_mod):
+    assert app_mod._estimate_size({"a": 1}) > 0
 
-    result = types.SimpleNamespace(structuredContent=None, content=["plain"])
-    assert json.loads(app_mod._serialize_tool_result(result)) == ["plain"]
 
-    result = types.SimpleNamespace(structuredContent=None, content="nope")
-    assert "nope" in json.loads(app_mod._serialize_tool_result(result))
+def test_lazy_log_arg(app_mod):
+    calls = []
+    lazy = app_mod._LazyLogArg(lambda value: calls.append(value) or len(value), "abc")
+    assert calls == []
+    assert str(lazy) == "3"
+    assert calls == ["abc"]
 
-    assert app_mod._serialize_tool_result(None) == ""
 
-    calls = app_mod._extract_function_calls([{"type": "function_call", "name": "x"}])
-    assert len(calls) == 1
-    assert app_mod._extract_function_calls("bad") == []
+def test_safe_log_payload(app_mod):
+    assert app_mod._safe_log_payload("short", max_chars=10) == "short"
+    assert "..." in app_mod._safe_log_payload("x" * 20, max_chars=10)
+    assert app_mod._safe_log_payload({"a": "b"}, max_chars=10).startswith("{")
+    assert "..." in app_mod._safe_log_payload({"bad": {1, 2}}, max_chars=10)
+
+
+def test_dumps(app_mod):
+    assert app_mod._dumps({"name": "Ворон", 1: [True]}) == '{"name":"Ворон","1":[true]}'
+    assert json.loads(app_mod._dumps({"big": 2**70})) == {"big": 2**70}
+    with pytest.raises(TypeError):
+        app_mod._dumps({1, 2})
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("", {}),
+        ({"a": 1}, {"a": 1}),
+        ("{\"a\": 2}", {"a": 2}),
+        ("bad", {}),
+        (123, {}),
+        ("{}", {}),
+        ("null", {}),
+        ("[1, 2]", {}),
+    ],
+)
+def test_parse_tool_args(app_mod, raw, expected):
+    assert app_mod._parse_tool_args(raw) == expected
+
+
+@pytest.mark.parametrize(
+    "structured, content, expected",
+    [
+        ({"ok": True}, [{"text": "skip"}], {"ok": True}),
+        (None, [Block()], [{"text": "hi"}]),
+        (None, ["plain"], ["plain"]),
+    ],
+)
+def test_tool_result_to_obj(app_mod, structured, content, expected):
+    result = FakeToolResult(structuredContent=structured, content=content)
+    assert app_mod._tool_result_to_obj(result) == expected
+
+
+def test_tool_result_to_obj_edge_cases(app_mod):
+    result = FakeToolResult(structuredContent=None, content="nope")
+    assert "nope" in app_mod._tool_result_to_obj(result)
+    assert app_mod._tool_result_to_obj(None) is None
+    result = FakeToolResult(structuredContent=None, content=[Block(), "plain"])
+    assert app_mod._tool_result_to_obj(result) == [{"text": "hi"}, "plain"]
+
+
+def test_tool_call_partition(app_mod):
+    assert app_mod._call_fields({"call_id": "c1", "name": "node", "arguments": "{}"}) == ("c1", "node", "{}")
+    assert app_mod._call_fields(types.SimpleNamespace(call_id="c2", name="edge")) == ("c2", "edge", None)
     edge_call = {"name": "edge", "arguments": "{\"action\":\"create\"}"}
     node_call = {"name": "node", "arguments": "{\"action\":\"create\"}"}
     assert app_mod._tool_call_priority(edge_call) > app_mod._tool_call_priority(node_call)
-    ordered = app_mod._prioritize_tool_calls([edge_call, node_call])
-    assert ordered[0] is node_call
+    assert app_mod._partition_tool_calls([edge_call, node_call]) == ([node_call], [edge_call])
+    edge_read = {"name": "edge", "arguments": "{\"action\":\"read\"}"}
+    second_edge = {"name": "edge", "arguments": {"action": "create"}}
+    ordered, deferred = app_mod._partition_tool_calls([edge_call, edge_read, second_edge, node_call])
+    assert ordered == [edge_read, node_call]
+    assert deferred == [edge_call, second_edge]
 
-    assert app_mod._normalize_model_name(None) == ""
-    assert app_mod._normalize_model_name(" GPT-5.2 ") == "gpt-5.2"
-    old_agent = app_mod.AGENT_MODEL_CONTEXT_TOKENS
-    old_assistant = app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS
-    app_mod.AGENT_MODEL_CONTEXT_TOKENS = 0
-    app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS = 0
-    assert app_mod._resolve_model_context_tokens("gpt-5.2") == 400000
-    app_mod.AGENT_MODEL_CONTEXT_TOKENS = 128
-    assert app_mod._resolve_model_context_tokens("unknown") == 128
-    app_mod.AGENT_MODEL_CONTEXT_TOKENS = 0
-    app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS = 256
-    assert app_mod._resolve_model_context_tokens("unknown") == 256
-    app_mod.AGENT_MODEL_CONTEXT_TOKENS = old_agent
-    app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS = old_assistant
 
+@pytest.mark.parametrize("model, expected", [(None, ""), (" GPT-5.2 ", "gpt-5.2")])
+def test_normalize_model_name(app_mod, model, expected):
+    assert app_mod._normalize_model_name(model) == expected
+
+
+@pytest.mark.parametrize(
+    "agent_tokens, assistant_tokens, model, expected",
+    [(0, 0, "gpt-5.2", 400000), (128, 0, "unknown", 128), (0, 256, "unknown", 256)],
+)
+def test_context_tokens_for(app_mod, monkeypatch, agent_tokens, assistant_tokens, model, expected):
+    monkeypatch.setattr(app_mod, "AGENT_MODEL_CONTEXT_TOKENS", agent_tokens)
+    monkeypatch.setattr(app_mod, "ASSISTANT_MODEL_CONTEXT_TOKENS", assistant_tokens)
+    assert app_mod._context_tokens_for(model) == expected
+
+
+def test_extract_text_chunks(app_mod):
     chunks = app_mod._extract_text_chunks([
         {"content": "hi"},
         {"content": [{"text": "part"}]},
@@ -214,23 +334,68 @@ def test_helpers_cover_branches():
     assert "raw" in chunks
     assert any("other" in chunk for chunk in chunks)
 
-    assert app_mod._extract_text_chunks({"content": "solo"}) == ["solo"]
-    assert app_mod._extract_text_chunks({"content": [{"text": "solo"}]}) == ["solo"]
-    assert app_mod._extract_text_chunks(123) == ["123"]
 
+@pytest.mark.parametrize(
+    "value, expected",
+    [({"content": "solo"}, ["solo"]), ({"content": [{"text": "solo"}]}, ["solo"]), (123, ["123"])],
+)
+def test_extract_text_chunks_single_values(app_mod, value, expected):
+    assert app_mod._extract_text_chunks(value) == expected
+
+
+def test_count_tokens_falls_back_when_encoder_fails(app_mod, monkeypatch):
     def _bad_encoder(_model):
         raise Exception("boom")
 
-    original_get_encoder = app_mod._get_encoder
-    app_mod._get_encoder = _bad_encoder
+    monkeypatch.setattr(app_mod, "_get_encoder", _bad_encoder)
     assert app_mod._count_tokens("abcd", "gpt-5.2") == 1
-    app_mod._get_encoder = original_get_encoder
+    assert app_mod._calculate_context("gpt-5.2", "abcd", None)["usedTokens"] == 1
+
 
+def test_extend_context_matches_full_count(app_mod, fast_encoder):
     context = app_mod._calculate_context("gpt-5.2", "hello", [{"content": "world"}], ["done"])
     assert context["usedTokens"] > 0
+    assert app_mod._calculate_context("gpt-5.2", "hello", [{"content": "world"}], iter(["done", "", None])) == context
+    base = app_mod._calculate_context("gpt-5.2", "hello", [{"content": "world"}])
+    assert app_mod._extend_context(base, fast_encoder, "done") == context
+    assert app_mod._extend_context(base, fast_encoder, "") is base
+    empty = app_mod._context_from_tokens(0, 0)
+    assert app_mod._extend_context(empty, None, "done") is empty
+
 
+class BatchEncoder:
+    def encode_batch(self, texts):
+        return [list(text) for text in texts]
 
-def test_extract_response_text_variants():
+
+@pytest.mark.parametrize(
+    "encoder, chunks, expected",
+    [(BatchEncoder(), ["hello", "", "world"], 10), (BatchEncoder(), [""], 0), (None, ["abcdefgh"], 2)],
+)
+def test_count_tokens_batch(app_mod, encoder, chunks, expected):
+    assert app_mod._count_tokens_batch(encoder, chunks) == expected
+
+
+def test_json_formatter_renders_extras_and_exceptions(app_mod):
+    formatter = app_mod.JsonFormatter()
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        record = app_mod.logger.makeRecord(
+            "agent", 40, __file__, 1, "failed %s", ("run",), sys.exc_info(),
+            extra={"request_id": "req-1", "path": "/run"}, sinfo="stack",
+        )
+    payload = json.loads(formatter.format(record))
+    assert payload["message"] == "failed run"
+    assert payload["levelname"] == "ERROR"
+    assert payload["request_id"] == "req-1"
+    assert payload["path"] == "/run"
+    assert "RuntimeError: boom" in payload["exc_info"]
+    assert payload["stack_info"] == "stack"
+    assert "args" not in payload
+
+
+def test_extract_response_text_variants(app_mod):
     class OutputText:
         output_text = "inline"
 
@@ -250,14 +415,20 @@ def test_extract_response_text_variants():
     assert app_mod._extract_response_text(response) == ""
 
 
-def test_context_helper_branches(monkeypatch):
+def test_context_helper_branches(app_mod, monkeypatch):
     old_agent = app_mod.AGENT_MODEL_CONTEXT_TOKENS
     old_assistant = app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS
     app_mod.AGENT_MODEL_CONTEXT_TOKENS = 0
     app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS = 0
-    assert app_mod._resolve_model_context_tokens(None) == 0
-    assert app_mod._resolve_model_context_tokens("gpt-5.2-mini") == 400000
-    assert app_mod._resolve_model_context_tokens("unknown") == 0
+    assert app_mod._context_tokens_for("") == 0
+    assert app_mod._context_tokens_for("gpt-5.2-mini") == 400000
+    assert app_mod._context_tokens_for("unknown") == 0
+    assert app_mod._calculate_context("unknown", "hello", "world") == {
+        "maxTokens": 0,
+        "usedTokens": 0,
+        "remainingTokens": 0,
+        "remainingRatio": 0,
+    }
     app_mod.AGENT_MODEL_CONTEXT_TOKENS = old_agent
     app_mod.ASSISTANT_MODEL_CONTEXT_TOKENS = old_assistant
 
@@ -275,14 +446,18 @@ def test_context_helper_branches(monkeypatch):
 
     monkeypatch.setattr(app_mod.tiktoken, "encoding_for_model", fake_encoding_for_model)
     monkeypatch.setattr(app_mod.tiktoken, "get_encoding", fake_get_encoding)
-    encoder = app_mod._get_encoder("unknown-model")
-    assert isinstance(encoder, FakeEncoder)
+    app_mod._cached_encoder.cache_clear()
+    try:
+        encoder = app_mod._get_encoder("unknown-model")
+        assert isinstance(encoder, FakeEncoder)
+        assert app_mod._get_encoder(" Unknown-Model ") is encoder
+    finally:
+        app_mod._cached_encoder.cache_clear()
 
     assert app_mod._count_tokens("", "gpt-5.2") == 0
-    assert app_mod._stringify_payload("raw") == "raw"
-    assert app_mod._stringify_payload(set([1, 2])).startswith("{")
 
     assert app_mod._extract_text_chunks(None) == []
+    assert app_mod._extract_text_chunks([{"content": [{1, 2}]}, {3}]) == [str({1, 2}), str({3})]
     assert "textpart" in app_mod._extract_text_chunks([{"content": ["textpart"]}])
     chunks = app_mod._extract_text_chunks([{"content": [{"text": 123}, 456]}])
     assert any("123" in chunk for chunk in chunks)
@@ -292,184 +467,151 @@ def test_context_helper_branches(monkeypatch):
     assert "alpha" in dict_chunks
     assert any("7" in chunk for chunk in dict_chunks)
     assert any("8" in chunk for chunk in dict_chunks)
-    assert app_mod._extract_text_chunks({"content": None, "other": 1}) == [app_mod._stringify_payload({"content": None, "other": 1})]
+    assert app_mod._extract_text_chunks({"content": None, "other": 1}) == [app_mod._dumps({"content": None, "other": 1})]
+    # Integers wider than 64 bits take _dumps' stdlib fallback, exactly as when the payload is sent.
+    assert app_mod._extract_text_chunks([{"big": 2**70}]) == [app_mod._dumps({"big": 2**70})]
 
 
-def test_prompt_file_creation_in_new_dir(tmp_path):
-    original_path = app_mod.PROMPT_PATH
-    original_cache = app_mod._prompt_cache
-    original_mtime = app_mod._prompt_mtime
+def test_prompt_file_creation_in_new_dir(app_mod, prompt_state, tmp_path):
     new_path = tmp_path / "nested" / "prompt.txt"
     app_mod.PROMPT_PATH = str(new_path)
-    app_mod._prompt_cache = None
-    app_mod._prompt_mtime = None
-    try:
-        prompt = app_mod._load_prompt_text()
-        assert "Raven" in prompt
-        assert new_path.exists()
-    finally:
-        app_mod.PROMPT_PATH = original_path
-        app_mod._prompt_cache = original_cache
-        app_mod._prompt_mtime = original_mtime
+    prompt = app_mod._load_prompt_text()
+    assert "Raven" in prompt
+    assert new_path.exists()
 
 
-def test_prompt_load_falls_back_on_empty(tmp_path):
-    original_path = app_mod.PROMPT_PATH
-    original_cache = app_mod._prompt_cache
-    original_mtime = app_mod._prompt_mtime
+def test_prompt_load_falls_back_on_empty(app_mod, prompt_state, tmp_path):
     path = tmp_path / "prompt.txt"
     path.parent.mkdir(parents=True, exist_ok=True)
     path.write_text("   ")
     app_mod.PROMPT_PATH = str(path)
-    app_mod._prompt_cache = None
-    app_mod._prompt_mtime = None
-    try:
-        prompt = app_mod._load_prompt_text()
-        assert "Raven" in prompt
-    finally:
-        app_mod.PROMPT_PATH = original_path
-        app_mod._prompt_cache = original_cache
-        app_mod._prompt_mtime = original_mtime
+    prompt = app_mod._load_prompt_text()
+    assert "Raven" in prompt
 
 
-def test_prompt_load_handles_getmtime_error(monkeypatch, tmp_path):
-    original_path = app_mod.PROMPT_PATH
-    original_cache = app_mod._prompt_cache
-    original_mtime = app_mod._prompt_mtime
-    path = tmp_path / "prompt.txt"
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text("Hello")
-    app_mod.PROMPT_PATH = str(path)
-    app_mod._prompt_cache = None
-    app_mod._prompt_mtime = None
-    monkeypatch.setattr(app_mod.os.path, "getmtime", lambda _path: (_ for _ in ()).throw(OSError("boom")))
-    try:
-        prompt = app_mod._load_prompt_text()
-        assert "Hello" in prompt
-    finally:
-        app_mod.PROMPT_PATH = original_path
-        app_mod._prompt_cache = original_cache
-        app_mod._prompt_mtime = original_mtime
+def _break_getmtime(app_mod, monkeypatch, _path):
+    monkeypatch.setattr(app_mod.os.path, "getmtime", _raise_os_boom)
 
 
-def test_prompt_load_handles_read_error(monkeypatch, tmp_path):
-    original_path = app_mod.PROMPT_PATH
-    original_cache = app_mod._prompt_cache
-    original_mtime = app_mod._prompt_mtime
-    path = tmp_path / "prompt.txt"
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text("Hello")
-    app_mod.PROMPT_PATH = str(path)
-    app_mod._prompt_cache = None
-    app_mod._prompt_mtime = None
+def _break_read(app_mod, monkeypatch, path):
     monkeypatch.setattr(app_mod, "_ensure_prompt_file", lambda: str(path))
-    monkeypatch.setattr(builtins, "open", lambda *args, **kwargs: (_ for _ in ()).throw(OSError("boom")))
-    try:
-        prompt = app_mod._load_prompt_text()
-        assert "Raven" in prompt
-    finally:
-        app_mod.PROMPT_PATH = original_path
-        app_mod._prompt_cache = original_cache
-        app_mod._prompt_mtime = original_mtime
-
-
-def test_prompt_save_handles_getmtime_error(monkeypatch, tmp_path):
-    original_path = app_mod.PROMPT_PATH
-    original_cache = app_mod._prompt_cache
-    original_mtime = app_mod._prompt_mtime
+    monkeypatch.setattr(builtins, "open", _raise_os_boom)
+
+
+@pytest.mark.parametrize(
+    "break_io, action, expected, mtime_missing",
+    [
+        (_break_getmtime, lambda app: app._load_prompt_text(), "Hello", True),
+        (_break_read, lambda app: app._load_prompt_text(), "Raven", False),
+        (_break_getmtime, lambda app: app._save_prompt_text("Hello"), "Hello", True),
+    ],
+    ids=["load-getmtime", "load-read", "save-getmtime"],
+)
+def test_prompt_error_paths(app_mod, prompt_state, monkeypatch, tmp_path, break_io, action, expected, mtime_missing):
     path = tmp_path / "prompt.txt"
+    path.write_text("Hello")
     app_mod.PROMPT_PATH = str(path)
-    app_mod._prompt_cache = None
-    app_mod._prompt_mtime = None
-    monkeypatch.setattr(app_mod.os.path, "getmtime", lambda _path: (_ for _ in ()).throw(OSError("boom")))
-    try:
-        saved = app_mod._save_prompt_text("Hello")
-        assert saved == "Hello"
-        assert app_mod._prompt_mtime is None
-    finally:
-        app_mod.PROMPT_PATH = original_path
-        app_mod._prompt_cache = original_cache
-        app_mod._prompt_mtime = original_mtime
+    break_io(app_mod, monkeypatch, path)
+    assert expected in action(app_mod)
+    assert (app_mod._prompt_mtime is None) is mtime_missing
 
 
 @pytest.mark.asyncio
-async def test_run_success_with_parsed_response(monkeypatch):
+async def test_run_success_with_parsed_response(app_mod, client, fake_openai):
     capture = {}
     result = FakeResponse(output_parsed=app_mod.AssistantResponse(message="hi"), response_id="resp_1")
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=result, capture=capture, **kwargs))
+    fake_openai(result=result, capture=capture)
 
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "input": "hello",
-            "maxTurns": 3,
-            "openaiTimeoutMs": 1500,
-        })
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "input": "hello",
+        "maxTurns": 3,
+        "openaiTimeoutMs": 1500,
+    })
 
     assert resp.status_code == 200
-    assert resp.json()["output"] == "hi"
-    assert resp.json()["context"]["maxTokens"] == 400000
+    body = resp.json()
+    assert body["output"] == "hi"
+    assert body["context"]["maxTokens"] == 400000
+
+
+@pytest.mark.asyncio
+async def test_openai_clients_share_one_http_client(app_mod, monkeypatch):
+    class RecordingClient:
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+    monkeypatch.setattr(app_mod, "AsyncOpenAI", RecordingClient)
+    monkeypatch.setattr(app_mod, "OPENAI_CLIENT_CACHE_SIZE", 2)
+    first = app_mod._get_openai_client("sk-a", None, 1.5)
+    assert app_mod._get_openai_client("sk-a", "", 1.5) is first
+    evicted = app_mod._get_openai_client("sk-b", None, 1.5)
+    app_mod._get_openai_client("sk-a", None, 1.5)
+    last = app_mod._get_openai_client("sk-c", None, None)
+    assert len(app_mod._openai_clients) == 2
+    assert first in app_mod._openai_clients.values()
+    assert evicted not in app_mod._openai_clients.values()
+
+    # Evicted clients own no connections; the shared pool outlives them and is closed once.
+    shared = first.kwargs["http_client"]
+    assert evicted.kwargs["http_client"] is shared and last.kwargs["http_client"] is shared
+    assert last.kwargs["timeout"] is None
+
+    async with app_mod.lifespan(app_mod.app):
+        pass
+    assert shared.is_closed
+    assert not app_mod._openai_clients
+
+    app_mod._openai_clients["stale"] = first
+    replacement = app_mod._get_openai_client("sk-a", None, 1.5)
+    assert replacement is not first
+    assert replacement.kwargs["http_client"] is not shared
+    assert "stale" not in app_mod._openai_clients
+    await app_mod._close_openai_clients()
 
 
 @pytest.mark.asyncio
-async def test_run_success_with_dict_parsed(monkeypatch):
+async def test_run_success_with_dict_parsed(client, fake_openai):
     result = FakeResponse(output_parsed={"message": "dict"}, response_id="resp_2")
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=result, **kwargs))
+    fake_openai(result=result)
 
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-        })
+    resp = await client.post("/run", content=BODY_BASIC, headers=JSON_HEADERS)
 
     assert resp.status_code == 200
     assert resp.json()["output"] == "dict"
 
 
 @pytest.mark.asyncio
-async def test_run_fallback_to_output_text(monkeypatch):
+async def test_run_fallback_to_output_text(client, fake_openai):
     result = FakeResponse(output_parsed=None, output_text="fallback", response_id="resp_3")
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=result, **kwargs))
+    fake_openai(result=result)
 
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-        })
+    resp = await client.post("/run", content=BODY_BASIC, headers=JSON_HEADERS)
 
     assert resp.status_code == 200
     assert resp.json()["output"] == "fallback"
 
 
 @pytest.mark.asyncio
-async def test_run_with_mcp_tool_config(monkeypatch, fake_mcp_context):
+async def test_run_with_mcp_tool_config(app_mod, monkeypatch, fake_mcp_context, client, fake_openai):
     capture = {}
     result = FakeResponse(output_parsed=app_mod.AssistantResponse(message="ok"), response_id="resp_4")
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=result, capture=capture, **kwargs))
+    fake_openai(result=result, capture=capture)
     monkeypatch.setattr(app_mod, "mcp_session_context", fake_mcp_context)
 
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-            "mcp": {
-                "url": "http://mcp",
-                "token": "mcp_token",
-                "sessionId": "session-123",
-                "allowedTools": ["node", "  ", "edge"],
-            },
-        })
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+        "mcp": {
+            "url": "http://mcp",
+            "token": "mcp_token",
+            "sessionId": "session-123",
+            "allowedTools": ["node", "  ", "edge"],
+        },
+    })
 
     assert resp.status_code == 200
     tools = capture.get("tools")
@@ -478,23 +620,18 @@ async def test_run_with_mcp_tool_config(monkeypatch, fake_mcp_context):
 
 
 @pytest.mark.asyncio
-async def test_run_handles_api_status_error(monkeypatch):
+async def test_run_handles_api_status_error(client, fake_openai):
+    from openai import APIStatusError
+
     response = httpx.Response(
         401,
         request=httpx.Request("POST", "https://api.openai.com/v1/responses"),
         json={"error": {"message": "bad key", "code": "invalid_api_key"}},
     )
     err = APIStatusError("bad key", response=response, body={"error": {"message": "bad key", "code": "invalid_api_key"}})
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(error=err, **kwargs))
+    fake_openai(error=err)
 
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-        })
+    resp = await client.post("/run", content=BODY_BASIC, headers=JSON_HEADERS)
 
     assert resp.status_code == 401
     detail = resp.json()["detail"]
@@ -502,14 +639,23 @@ async def test_run_handles_api_status_error(monkeypatch):
     assert detail["message"] == "bad key"
 
 
-@pytest.mark.asyncio
-async def test_run_tool_loop_executes_calls(monkeypatch):
-    session = FakeSession()
+def test_openai_error_details_variants(app_mod):
+    from openai import APIStatusError
+
+    response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com/v1/responses"))
+
+    def make(body):
+        return APIStatusError("fallback", response=response, body=body)
+
+    assert app_mod._openai_error_details(make({"error": {"type": "rate_limit", "message": "slow"}})) == ("rate_limit", "slow")
+    assert app_mod._openai_error_details(make(b'{"error": {"code": "quota"}}')) == ("quota", "fallback")
+    assert app_mod._openai_error_details(make("not json")) == (None, "fallback")
+    assert app_mod._openai_error_details(make({"error": "flat"})) == (None, "fallback")
+    assert app_mod._openai_error_details(make(None)) == (None, "fallback")
 
-    @asynccontextmanager
-    async def _ctx(_config, _timeout):
-        yield session, [FakeTool("node", "create node")]
 
+@pytest.mark.asyncio
+async def test_run_tool_loop_executes_calls(app_mod, monkeypatch, client, fake_session, fake_mcp_context, fast_encoder, fake_openai):
     first = FakeResponse(
         output=[
             {
@@ -522,36 +668,33 @@ async def test_run_tool_loop_executes_calls(monkeypatch):
         response_id="resp_1",
     )
     second = FakeResponse(output_parsed=app_mod.AssistantResponse(message="done"), response_id="resp_2")
-    monkeypatch.setattr(app_mod, "mcp_session_context", _ctx)
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(results=[first, second], **kwargs))
-
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-            "mcp": {
-                "url": "http://mcp",
-                "sessionId": "session-123",
-                "allowedTools": ["node"],
-            },
-        })
+    capture = {}
+    monkeypatch.setattr(app_mod, "mcp_session_context", fake_mcp_context)
+    fake_openai(results=[first, second], capture=capture)
+
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+        "mcp": {
+            "url": "http://mcp",
+            "sessionId": "session-123",
+            "allowedTools": ["node"],
+        },
+    })
 
     assert resp.status_code == 200
-    assert resp.json()["output"] == "done"
-    assert session.calls == [("node", {"title": "Test", "x": 1, "y": 2})]
+    body = resp.json()
+    assert body["output"] == "done"
+    assert fake_session.calls == [("node", {"title": "Test", "x": 1, "y": 2})]
+    tool_output = app_mod._dumps({"isError": False, "content": {"ok": True, "args": {"title": "Test", "x": 1, "y": 2}}})
+    expected = app_mod._calculate_context("gpt-5.2", capture["instructions"], "hello", [tool_output, "done"])
+    assert body["context"] == expected
 
 
 @pytest.mark.asyncio
-async def test_run_tool_loop_exhausts_calls(monkeypatch):
-    session = FakeSession()
-
-    @asynccontextmanager
-    async def _ctx(_config, _timeout):
-        yield session, [FakeTool("node", "create node")]
-
+async def test_run_tool_loop_exhausts_calls(app_mod, monkeypatch, client, fake_session, fake_mcp_context, fake_openai):
     first = FakeResponse(
         output=[
             {"type": "function_call", "call_id": "call_1", "name": "node", "arguments": "{}"},
@@ -563,33 +706,119 @@ async def test_run_tool_loop_exhausts_calls(monkeypatch):
         output_text="exhausted",
         response_id="resp_exhaust_2",
     )
-    monkeypatch.setattr(app_mod, "mcp_session_context", _ctx)
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(results=[first, second], **kwargs))
+    monkeypatch.setattr(app_mod, "mcp_session_context", fake_mcp_context)
+    fake_openai(results=[first, second])
 
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-            "maxTurns": 1,
-            "mcp": {"url": "http://mcp"},
-        })
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+        "maxTurns": 1,
+        "mcp": {"url": "http://mcp"},
+    })
 
     assert resp.status_code == 200
     assert resp.json()["output"] == "exhausted"
-    assert session.calls == [("node", {}), ("node", {})]
+    assert fake_session.calls == [("node", {}), ("node", {})]
 
 
 @pytest.mark.asyncio
-async def test_context_endpoint():
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/context", json={
-            "model": "gpt-5.2",
-            "input": [{"content": "Hello"}],
-        })
+async def test_invoke_tool_calls_parallelizes_reads_only_and_defers_edges(app_mod):
+    class SlowSession:
+        def __init__(self):
+            self.active = 0
+            self.peak = 0
+            self.events = []
+
+        async def call_tool(self, name, args):
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.events.append(("start", name))
+            await asyncio.sleep(0.01)
+            self.events.append(("end", name))
+            self.active -= 1
+            return FakeToolResult(structuredContent={"name": name})
+
+    session = SlowSession()
+    calls = [
+        {"call_id": "c1", "name": "edge", "arguments": "{\"action\":\"create\"}"},
+        {"call_id": "c2", "name": "node", "arguments": "{}"},
+        {"call_id": "c3", "name": "node", "arguments": "{}"},
+        {"call_id": "c4", "name": "node", "arguments": "{}"},
+        {"name": "node", "arguments": "{}"},
+    ]
+    results = await app_mod._invoke_tool_calls(session, calls, 2)
+
+    assert [item[0] if item else None for item in results] == ["c2", "c3", "c4", None, "c1"]
+    assert session.peak == 1
+    assert session.events.index(("start", "edge")) > max(
+        i for i, event in enumerate(session.events) if event == ("end", "node")
+    )
+
+    session = SlowSession()
+    calls = [
+        {"call_id": "r1", "name": "get_state", "arguments": "{}"},
+        {"call_id": "r2", "name": "node", "arguments": "{\"action\":\"read\"}"},
+        {"call_id": "r3", "name": "list_canvas_participants", "arguments": "{}"},
+        {"call_id": "w1", "name": "node", "arguments": "{\"action\":\"update\"}"},
+        {"call_id": "r4", "name": "edge", "arguments": "{\"action\":\"read\"}"},
+    ]
+    results = await app_mod._invoke_tool_calls(session, calls, 8)
+
+    assert [item[0] for item in results] == ["r1", "r2", "r3", "w1", "r4"]
+    assert session.peak == 3
+    write_start = session.events.index(("start", "node"), 3)
+    assert write_start == 6
+    assert session.events[write_start + 1] == ("end", "node")
+
+
+@pytest.mark.asyncio
+async def test_invoke_tool_calls_reraises_tool_errors(app_mod):
+    class FailingSession:
+        async def call_tool(self, name, args):
+            raise RuntimeError(f"{name} failed")
+
+    with pytest.raises(RuntimeError, match="node failed"):
+        await app_mod._invoke_tool_calls(FailingSession(), [{"call_id": "c1", "name": "node"}], 4)
+
+    with pytest.raises(RuntimeError, match="get_state failed"):
+        await app_mod._invoke_tool_calls(FailingSession(), [{"call_id": "c1", "name": "get_state"}], 4)
+
+
+@pytest.mark.asyncio
+async def test_invoke_tool_calls_stops_writes_after_failure(app_mod):
+    class PartialSession:
+        def __init__(self):
+            self.calls = []
+
+        async def call_tool(self, name, args):
+            self.calls.append((name, args.get("action")))
+            if args.get("action") == "update":
+                raise RuntimeError("update failed")
+            return FakeToolResult(structuredContent={"name": name})
+
+    session = PartialSession()
+    calls = [
+        {"call_id": "c1", "name": "node", "arguments": "{\"action\":\"create\"}"},
+        {"call_id": "c2", "name": "node", "arguments": "{\"action\":\"update\"}"},
+        {"call_id": "c3", "name": "send_alert", "arguments": "{}"},
+        {"call_id": "c4", "name": "edge", "arguments": "{\"action\":\"create\"}"},
+    ]
+    with pytest.raises(RuntimeError, match="update failed"):
+        await app_mod._invoke_tool_calls(session, calls, 4)
+
+    # Writes before the failure stay applied; nothing after it runs.
+    assert session.calls == [("node", "create"), ("node", "update")]
+    assert not app_mod._is_read_only_tool_call({"name": "send_alert", "arguments": "{\"action\":\"read\"}"})
+
+
+@pytest.mark.asyncio
+async def test_context_endpoint(client):
+    resp = await client.post("/context", json={
+        "model": "gpt-5.2",
+        "input": [{"content": "Hello"}],
+    })
     assert resp.status_code == 200
     context = resp.json()["context"]
     assert context["maxTokens"] == 400000
@@ -597,13 +826,7 @@ async def test_context_endpoint():
 
 
 @pytest.mark.asyncio
-async def test_run_tool_loop_limit(monkeypatch):
-    session = FakeSession()
-
-    @asynccontextmanager
-    async def _ctx(_config, _timeout):
-        yield session, [FakeTool("node", "create node")]
-
+async def test_run_tool_loop_limit(app_mod, monkeypatch, client, fake_session, fake_mcp_context, fake_openai):
     first = FakeResponse(
         output=[
             {
@@ -619,100 +842,87 @@ async def test_run_tool_loop_limit(monkeypatch):
         output_text="limit",
         response_id="resp_2",
     )
-    monkeypatch.setattr(app_mod, "mcp_session_context", _ctx)
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(results=[first, second], **kwargs))
-
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-            "maxTurns": 0,
-            "mcp": {
-                "url": "http://mcp",
-            },
-        })
+    monkeypatch.setattr(app_mod, "mcp_session_context", fake_mcp_context)
+    fake_openai(results=[first, second])
+
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+        "maxTurns": 0,
+        "mcp": {
+            "url": "http://mcp",
+        },
+    })
 
     assert resp.status_code == 200
     assert resp.json()["output"] == "limit"
-    assert session.calls == [("node", {"title": "Test"})]
+    assert fake_session.calls == [("node", {"title": "Test"})]
 
 
 @pytest.mark.asyncio
-async def test_run_tool_loop_skips_invalid_calls(monkeypatch):
-    session = FakeSession()
-
-    @asynccontextmanager
-    async def _ctx(_config, _timeout):
-        yield session, [FakeTool("node", "create node")]
-
+async def test_run_tool_loop_skips_invalid_calls(app_mod, monkeypatch, client, fake_session, fake_mcp_context, fake_openai):
     response = FakeResponse(
         output=[{"type": "function_call", "name": "node", "arguments": "{}"}],
         output_text="skip",
         response_id="resp_1",
     )
-    monkeypatch.setattr(app_mod, "mcp_session_context", _ctx)
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=response, **kwargs))
-
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-            "mcp": {
-                "url": "http://mcp",
-            },
-        })
+    monkeypatch.setattr(app_mod, "mcp_session_context", fake_mcp_context)
+    fake_openai(result=response)
+
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+        "mcp": {
+            "url": "http://mcp",
+        },
+    })
 
     assert resp.status_code == 200
     assert resp.json()["output"] == "skip"
-    assert session.calls == []
+    assert fake_session.calls == []
 
 
 @pytest.mark.asyncio
-async def test_run_filters_mcp_tools(monkeypatch):
+async def test_run_filters_mcp_tools(app_mod, monkeypatch, client, fake_session, fake_openai):
     tools = [FakeTool(None), FakeTool("node")]
-    session = FakeSession()
 
     @asynccontextmanager
     async def _ctx(_config, _timeout):
-        yield session, tools
+        yield fake_session, tools
 
     capture = {}
     result = FakeResponse(output_parsed=app_mod.AssistantResponse(message="ok"), response_id="resp_filter")
     monkeypatch.setattr(app_mod, "mcp_session_context", _ctx)
-    monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=result, capture=capture, **kwargs))
-
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/run", json={
-            "apiKey": "sk-test",
-            "model": "gpt-5.2",
-            "instructions": "hi",
-            "input": "hello",
-            "mcp": {
-                "url": "http://mcp",
-                "allowedTools": ["edge"],
-            },
-        })
+    fake_openai(result=result, capture=capture)
+
+    resp = await client.post("/run", json={
+        "apiKey": "sk-test",
+        "model": "gpt-5.2",
+        "instructions": "hi",
+        "input": "hello",
+        "mcp": {
+            "url": "http://mcp",
+            "allowedTools": ["edge"],
+        },
+    })
 
     assert resp.status_code == 200
     assert capture.get("tools") is None
 
 
 @pytest.mark.asyncio
-async def test_mcp_session_context_no_config():
+async def test_mcp_session_context_no_config(app_mod):
     async with app_mod.mcp_session_context(None, None) as (session, tools):
         assert session is None
         assert tools == []
 
 
 @pytest.mark.asyncio
-async def test_mcp_session_context_with_fake_stream(monkeypatch):
+async def test_mcp_session_context_with_fake_stream(app_mod, monkeypatch):
     captured_headers = {}
     class DummySession:
         def __init__(self, _read, _write, read_timeout_seconds=None):
@@ -747,60 +957,58 @@ async def test_mcp_session_context_with_fake_stream(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_prompt_endpoints():
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        initial = await client.get("/prompt")
-        assert initial.status_code == 200
-        original = initial.json()["prompt"]
-        assert "Raven" in original
+async def test_prompt_endpoints(client, original_prompt):
+    initial = await client.get("/prompt")
+    assert initial.status_code == 200
+    assert initial.json()["prompt"] == original_prompt
+    assert "Raven" in original_prompt
+
+    updated = "You are Raven. Stay concise."
+    resp = await client.post("/prompt", json={"prompt": updated})
+    assert resp.status_code == 200
+    assert resp.json()["prompt"] == updated
 
-        updated = "You are Raven. Stay concise."
-        resp = await client.post("/prompt", json={"prompt": updated})
-        assert resp.status_code == 200
-        assert resp.json()["prompt"] == updated
+    reread = await client.get("/prompt")
+    assert reread.status_code == 200
+    assert reread.json()["prompt"] == updated
 
-        reread = await client.get("/prompt")
-        assert reread.status_code == 200
-        assert reread.json()["prompt"] == updated
+    ui = await client.get("/prompt/ui")
+    assert ui.status_code == 200
+    assert ui.headers["content-type"] == "text/html; charset=utf-8"
+    assert "<textarea" in ui.text
+    assert f'<textarea id="prompt">{updated}</textarea>' in ui.text
 
-        ui = await client.get("/prompt/ui")
-        assert ui.status_code == 200
-        assert "<textarea" in ui.text
+    reset = await client.post("/prompt", json={"prompt": original_prompt})
+    assert reset.status_code == 200
 
-        reset = await client.post("/prompt", json={"prompt": original})
-        assert reset.status_code == 200
+    ui = await client.get("/prompt/ui")
+    assert updated not in ui.text
 
 
 @pytest.mark.asyncio
-async def test_prompt_update_rejects_empty():
-    transport = httpx.ASGITransport(app=app_mod.app)
-    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-        resp = await client.post("/prompt", json={"prompt": "  "})
+async def test_prompt_update_rejects_empty(client):
+    resp = await client.post("/prompt", json={"prompt": "  "})
     assert resp.status_code == 400
     assert resp.json()["detail"] == "prompt_required"
 
 
 @pytest.mark.asyncio
-async def test_run_builds_instructions_with_prompt(monkeypatch):
+async def test_run_builds_instructions_with_prompt(app_mod, client, original_prompt, fake_openai):
     capture = {}
-    original = app_mod._load_prompt_text()
     app_mod._save_prompt_text("Base prompt.")
     try:
         result = FakeResponse(output_parsed=app_mod.AssistantResponse(message="ok"), response_id="resp_9")
-        monkeypatch.setattr(app_mod, "AsyncOpenAI", lambda **kwargs: FakeClient(result=result, capture=capture, **kwargs))
-
-        transport = httpx.ASGITransport(app=app_mod.app)
-        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
-            resp = await client.post("/run", json={
-                "apiKey": "sk-test",
-                "model": "gpt-5.2",
-                "input": "hello",
-                "userName": "Ada",
-                "instructions": "Extra.",
-            })
+        fake_openai(result=result, capture=capture)
+
+        resp = await client.post("/run", json={
+            "apiKey": "sk-test",
+            "model": "gpt-5.2",
+            "input": "hello",
+            "userName": "Ada",
+            "instructions": "Extra.",
+        })
     finally:
-        app_mod._save_prompt_text(original)
+        app_mod._save_prompt_text(original_prompt)
 
     assert resp.status_code == 200
     built = capture.get("instructions", "")
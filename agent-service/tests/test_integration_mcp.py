@@ -1,27 +1,45 @@
+import asyncio
+import functools
 import os
+import re
 import subprocess
 import time
+import uuid
 from pathlib import Path
 
 import httpx
+import orjson
 import pytest
+import pytest_asyncio
 
 
+# Comment lines never match because "#" is not a valid key character.
+_ENV_RE = re.compile(rb"(?m)^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t\r]*$")
+
+
+def _parse_env(data: bytes) -> dict[str, str]:
+    return {match.group(1).decode(): match.group(2).decode() for match in _ENV_RE.finditer(data)}
+
+
+@functools.lru_cache(maxsize=1)
 def load_env_file():
     env_path = Path(__file__).resolve().parents[2] / ".env"
     if not env_path.exists():
         return
-    for line in env_path.read_text().splitlines():
-        if not line or line.lstrip().startswith("#") or "=" not in line:
-            continue
-        key, value = line.split("=", 1)
-        key = key.strip()
-        if not key or key in os.environ:
-            continue
-        os.environ[key] = value.strip()
+    for key, value in _parse_env(env_path.read_bytes()).items():
+        os.environ.setdefault(key, value)
 
 
-def get_db_key(email: str) -> str:
+KEY_QUERY = (
+    "SELECT ok.api_key "
+    "FROM openai_keys ok "
+    "JOIN users u ON u.id = ok.user_id "
+    "WHERE lower(u.email) = %s "
+    "LIMIT 1"
+)
+
+
+def _get_db_key_via_docker(email: str) -> str:
     container = os.getenv("DB_CONTAINER_NAME", "smart-tracker-db-1")
     safe_email = email.replace("'", "''")
     query = (
@@ -44,49 +62,115 @@ def get_db_key(email: str) -> str:
         query,
     ]
     try:
-        output = subprocess.check_output(cmd, text=True).strip()
-    except subprocess.CalledProcessError as exc:
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        proc.check_returncode()
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
         raise AssertionError(f"failed to read OpenAI key from db: {exc}") from exc
+    output = proc.stdout.strip()
     if not output:
         raise AssertionError("OpenAI key not found for test user")
     return output
 
 
-def login_and_get_key(api_base: str, email: str, password: str) -> str:
-    client = httpx.Client(base_url=api_base)
-    login = client.post("/api/auth/login", json={"email": email, "password": password})
-    assert login.status_code == 200, login.text
-    return get_db_key(email)
+@pytest.fixture(scope="session")
+def db_conn():
+    load_env_file()
+    host = os.getenv("DB_HOST")
+    if not host:
+        # Without a mapped Postgres port the key is read through `docker exec psql`.
+        yield None
+        return
+    psycopg = pytest.importorskip("psycopg")
+    conn = psycopg.connect(
+        host=host,
+        port=int(os.getenv("DB_PORT", "5432")),
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASSWORD", "postgres"),
+        dbname=os.getenv("DB_NAME", "smart_tracker"),
+        autocommit=True,
+    )
+    yield conn
+    conn.close()
+
+
+def get_db_key(db_conn, email: str) -> str:
+    if db_conn is None:
+        return _get_db_key_via_docker(email)
+    row = db_conn.execute(KEY_QUERY, (email,), prepare=True).fetchone()
+    if not row or not row[0]:
+        raise AssertionError("OpenAI key not found for test user")
+    return row[0]
+
+
+@pytest.fixture(scope="session")
+def api_key(db_conn):
+    load_env_file()
+    email = os.getenv("TEST_USER_EMAIL", "test@raven-ai.local").strip().lower()
+    return get_db_key(db_conn, email)
+
 
+API_LIMITS = httpx.Limits(max_keepalive_connections=10, keepalive_expiry=15.0)
+# Setup calls should answer in seconds; only the agent run is allowed a long read.
+API_TIMEOUT = httpx.Timeout(connect=2.0, read=5.0, write=5.0, pool=5.0)
+AGENT_TIMEOUT = httpx.Timeout(connect=5.0, read=180.0, write=5.0, pool=5.0)
+
+
+def api_base_url() -> str:
+    load_env_file()
+    return os.getenv("API_BASE_URL", "http://localhost:8080")
 
-def create_session(api_base: str) -> str:
-    client = httpx.Client(base_url=api_base)
-    resp = client.post("/api/sessions", json={"state": {"nodes": [], "edges": [], "drawings": [], "textBoxes": [], "comments": []}})
-    assert resp.status_code == 201, resp.text
-    return resp.json()["id"]
 
+@pytest_asyncio.fixture(scope="module")
+async def api_client():
+    async with httpx.AsyncClient(
+        base_url=api_base_url(),
+        timeout=API_TIMEOUT,
+        limits=API_LIMITS,
+    ) as client:
+        yield client
 
-def fetch_session(api_base: str, session_id: str) -> dict:
-    client = httpx.Client(base_url=api_base)
-    resp = client.get(f"/api/sessions/{session_id}")
+
+async def login(client: httpx.AsyncClient, email: str, password: str) -> None:
+    resp = await client.post("/api/auth/login", json={"email": email, "password": password})
     assert resp.status_code == 200, resp.text
-    return resp.json()
+
+
+async def create_session(client: httpx.AsyncClient) -> str:
+    resp = await client.post("/api/sessions", json={"state": {"nodes": [], "edges": [], "drawings": [], "textBoxes": [], "comments": []}})
+    resp.raise_for_status()
+    return orjson.loads(resp.content)["id"]
+
+
+async def fetch_session_nodes(
+    client: httpx.AsyncClient,
+    session_id: str,
+    title: str,
+    etag: str | None = None,
+    previous: list | None = None,
+) -> tuple[list, str | None]:
+    # Express sends an ETag for JSON responses, so unchanged polls come back as bodiless 304s.
+    headers = {"If-None-Match": etag} if etag and previous is not None else None
+    resp = await client.get(f"/api/sessions/{session_id}", headers=headers)
+    if resp.status_code == 304:
+        return previous, etag
+    resp.raise_for_status()
+    nodes = (orjson.loads(resp.content).get("state") or {}).get("nodes") or []
+    return [node for node in nodes if node.get("title") == title], resp.headers.get("ETag")
 
 
 @pytest.mark.integration
 @pytest.mark.asyncio
-async def test_agent_creates_node_via_mcp():
-    load_env_file()
-    api_base = os.getenv("API_BASE_URL", "http://localhost:8080")
+async def test_agent_creates_node_via_mcp(api_client, api_key):
     agent_base = os.getenv("AGENT_BASE_URL", "http://localhost:8001")
     mcp_url = os.getenv("MCP_URL", "http://mcp:7010/mcp")
     mcp_token = os.getenv("MCP_TECH_TOKEN", "raven_tech_token")
     email = os.getenv("TEST_USER_EMAIL", "test@raven-ai.local").strip().lower()
     password = os.getenv("TEST_USER_PASSWORD", "test1234")
 
-    api_key = login_and_get_key(api_base, email, password)
-    session_id = create_session(api_base)
-    title = f"MCP Integration {int(time.time())}"
+    # Session creation needs the login cookie, so it has to wait for the login response.
+    await login(api_client, email, password)
+    session_id = await create_session(api_client)
+    title = f"MCP Integration {uuid.uuid4().hex[:12]}"
 
     payload = {
         "apiKey": api_key,
@@ -103,18 +187,26 @@ async def test_agent_creates_node_via_mcp():
         },
     }
 
-    async with httpx.AsyncClient(base_url=agent_base, timeout=180) as client:
+    async with httpx.AsyncClient(
+        base_url=agent_base,
+        timeout=AGENT_TIMEOUT,
+        limits=API_LIMITS,
+    ) as client:
         resp = await client.post("/run", json=payload)
     assert resp.status_code == 200, resp.text
     assert resp.json().get("output"), "assistant output missing"
 
     found = False
-    for _ in range(6):
-        state = fetch_session(api_base, session_id)
-        nodes = state.get("state", {}).get("nodes", [])
-        if any(node.get("title") == title for node in nodes):
+    nodes = None
+    etag = None
+    deadline = time.monotonic() + 3.0
+    delay = 0.05
+    while time.monotonic() < deadline:
+        nodes, etag = await fetch_session_nodes(api_client, session_id, title, etag, nodes)
+        if nodes:
             found = True
             break
-        time.sleep(0.5)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.4)
 
     assert found, "node created by MCP not found in session state"
@@ -615,10 +615,36 @@ async function initDb() {
         updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
       );
     `);
+    // Skill embeddings are stored as halfvec when pgvector supports it (>= 0.7): half the bytes per row.
+    let skillEmbeddingType = 'vector';
     try {
-      await pool.query('CREATE INDEX IF NOT EXISTS assistant_skills_embedding_idx ON assistant_skills USING ivfflat (embedding vector_cosine_ops)');
+      const typeRes = await pool.query(
+        `SELECT format_type(atttypid, atttypmod) AS type
+           FROM pg_attribute
+          WHERE attrelid = 'assistant_skills'::regclass AND attname = 'embedding'`,
+      );
+      if (String(typeRes.rows[0]?.type ?? '').startsWith('halfvec')) {
+        skillEmbeddingType = 'halfvec';
+      } else {
+        await pool.query("SELECT '[1]'::halfvec");
+        await pool.query('DROP INDEX IF EXISTS assistant_skills_embedding_hnsw_idx');
+        await pool.query('DROP INDEX IF EXISTS assistant_skills_embedding_idx');
+        await pool.query(`ALTER TABLE assistant_skills ALTER COLUMN embedding TYPE halfvec(${dim}) USING embedding::halfvec(${dim})`);
+        skillEmbeddingType = 'halfvec';
+      }
     } catch {
-      // ignore
+      // ignore: older pgvector, keep vector storage
+    }
+    try {
+      await pool.query(`CREATE INDEX IF NOT EXISTS assistant_skills_embedding_hnsw_idx ON assistant_skills USING hnsw (embedding ${skillEmbeddingType}_cosine_ops) WITH (m = 16, ef_construction = 64)`);
+      await pool.query('DROP INDEX IF EXISTS assistant_skills_embedding_idx');
+    } catch {
+      // pgvector < 0.5 has no hnsw; keep the ivfflat index
+      try {
+        await pool.query(`CREATE INDEX IF NOT EXISTS assistant_skills_embedding_idx ON assistant_skills USING ivfflat (embedding ${skillEmbeddingType}_cosine_ops)`);
+      } catch {
+        // ignore
+      }
     }
   } else {
     await pool.query(`
@@ -670,6 +696,11 @@ async function initDb() {
   } catch {
     // ignore
   }
+  try {
+    await pool.query('ALTER TABLE assistant_skills ADD COLUMN IF NOT EXISTS embedding_hash BYTEA');
+  } catch {
+    // ignore
+  }
 
   await pool.query(`
     CREATE TABLE IF NOT EXISTS assistant_skill_versions (
@@ -686,6 +717,11 @@ async function initDb() {
   } catch {
     // ignore
   }
+  try {
+    await pool.query('CREATE UNIQUE INDEX IF NOT EXISTS assistant_skill_versions_skill_version_uniq ON assistant_skill_versions (skill_id, version)');
+  } catch {
+    // ignore
+  }
 
   await pool.query(`
     CREATE TABLE IF NOT EXISTS assistant_skill_runs (
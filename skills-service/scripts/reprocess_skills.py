@@ -1,16 +1,26 @@
 import argparse
 import asyncio
 from dataclasses import dataclass
-from datetime import datetime
-import json
+from datetime import datetime, timezone
+import io
 import os
-from typing import Any
+from typing import Any, AsyncIterator
 
 import asyncpg
+import numpy as np
 
 import app as skills
 
 
+# Opt-in pruning: when set, step similarity is only consulted for pairs whose embedding similarity
+# is within this margin of the merge threshold, so pairs further apart can no longer merge on step
+# overlap alone. Unset (the default) checks every pair, matching the service's merge rule exactly.
+_STEP_SIMILARITY_MARGIN = os.getenv("REPROCESS_STEP_SIMILARITY_MARGIN", "").strip()
+STEP_SIMILARITY_MARGIN = float(_STEP_SIMILARITY_MARGIN) if _STEP_SIMILARITY_MARGIN else None
+BASE_OUTPUT_MAX_CHARS = 2400
+REPROCESS_DB_CONNECTIONS = 2
+
+
 @dataclass
 class ReprocessedSkill:
     skill_id: str
@@ -21,25 +31,28 @@ class ReprocessedSkill:
     success_criteria: list[str]
     examples: list[dict[str, Any]]
     generalization_score: float
-    embedding: list[float]
+    embedding_text: str
     steps_payload: list[dict[str, Any]]
+    step_tokens: list[frozenset[str]]
+    embedding_hash: bytes
+    embedding: np.ndarray | None = None
 
 
-def _parse_json_list(value: Any) -> list[Any]:
-    if isinstance(value, list):
-        return value
-    if isinstance(value, str):
-        try:
-            parsed = json.loads(value)
-            return parsed if isinstance(parsed, list) else []
-        except json.JSONDecodeError:
-            return []
-    return []
+@dataclass
+class ClusterMerge:
+    base: ReprocessedSkill
+    parameters: list[dict[str, Any]]
+    preconditions: list[str]
+    success_criteria: list[str]
+    examples: list[dict[str, Any]]
+    generalization_score: float
+    embedding_text: str
+    embedding_hash: bytes
 
 
 def _build_draft_steps(raw_steps: Any) -> list[skills.SkillStep]:
     steps: list[skills.SkillStep] = []
-    for raw in _parse_json_list(raw_steps):
+    for raw in skills._json_list(raw_steps):
         if not isinstance(raw, dict):
             continue
         title = str(raw.get("title") or "Step").strip()
@@ -53,25 +66,47 @@ def _build_draft_steps(raw_steps: Any) -> list[skills.SkillStep]:
 
 def _build_base_output(
     description: str | None,
-    steps: list[dict[str, Any]],
+    steps: list[skills.SkillStep],
     examples: list[dict[str, Any]],
+    max_chars: int = BASE_OUTPUT_MAX_CHARS,
 ) -> str:
-    parts: list[str] = []
+    # Written in one pass and abandoned once the cap is reached, so long step lists are never
+    # formatted in full only to be clamped away.
+    buf = io.StringIO()
+    written = 0
+    separator = ""
+
+    def write(text: str) -> bool:
+        nonlocal written
+        buf.write(text)
+        written += len(text)
+        return written < max_chars
+
+    if description and not write(f"Description:\n{description}"):
+        return skills._clamp_text(buf.getvalue(), max_chars)
     if description:
-        parts.append(f"Description:\n{description}")
-    step_text = skills._format_steps_for_prompt(steps)
-    if step_text:
-        parts.append("Steps:\n" + step_text)
-    example_outputs: list[str] = []
+        separator = "\n\n"
+    header = f"{separator}Steps:\n"
+    for idx, step in enumerate(steps):
+        instructions = step.instructions.strip()
+        if not instructions:
+            continue
+        title = (step.title or f"Step {idx + 1}").strip()
+        if not write(f"{header}{idx + 1}. {title}: {instructions}"):
+            return skills._clamp_text(buf.getvalue(), max_chars)
+        header = "\n"
+        separator = "\n\n"
+    header = f"{separator}Example outputs:\n"
     for example in examples[:2]:
         if not isinstance(example, dict):
             continue
         output = str(example.get("outputSummary") or "").strip()
-        if output:
-            example_outputs.append(output)
-    if example_outputs:
-        parts.append("Example outputs:\n" + "\n".join(example_outputs))
-    return "\n\n".join(parts)
+        if not output:
+            continue
+        if not write(f"{header}{output}"):
+            break
+        header = "\n"
+    return skills._clamp_text(buf.getvalue(), max_chars)
 
 
 def _pick_user_query(entrypoint: str, name: str, examples: list[dict[str, Any]]) -> str:
@@ -88,14 +123,6 @@ def _pick_user_query(entrypoint: str, name: str, examples: list[dict[str, Any]])
     return "Generalize this skill."
 
 
-def _merge_score(left: ReprocessedSkill, right: ReprocessedSkill) -> float:
-    similarity = skills._cosine_similarity(left.embedding, right.embedding)
-    step_sim = skills._step_similarity(left.steps_payload, right.steps_payload)
-    weighted = similarity * 0.7 + step_sim * 0.3
-    boosted_similarity = min(1.0, similarity + skills.SKILLS_MERGE_SIMILARITY_EPS)
-    return max(weighted, boosted_similarity, step_sim)
-
-
 async def _load_user_id(conn: asyncpg.Connection, *, user_id: str | None, email: str | None) -> str:
     if user_id:
         return user_id
@@ -117,8 +144,9 @@ async def _load_api_key(conn: asyncpg.Connection, *, user_id: str) -> str | None
     return None
 
 
-async def _fetch_skills(conn: asyncpg.Connection, user_id: str) -> list[dict[str, Any]]:
-    rows = await conn.fetch(
+async def _stream_skills(conn: asyncpg.Connection, user_id: str) -> AsyncIterator[dict[str, Any]]:
+    # A server-side cursor keeps only `prefetch` rows (embeddings and JSON blobs included) in memory.
+    cursor = conn.cursor(
         """
         SELECT s.id,
                s.name,
@@ -129,6 +157,8 @@ async def _fetch_skills(conn: asyncpg.Connection, user_id: str) -> list[dict[str
                s.success_criteria,
                s.examples,
                s.generalization_score,
+               s.embedding,
+               s.embedding_hash,
                s.created_at,
                v.steps
           FROM assistant_skills s
@@ -137,8 +167,11 @@ async def _fetch_skills(conn: asyncpg.Connection, user_id: str) -> list[dict[str
          ORDER BY s.created_at ASC
         """,
         user_id,
+        prefetch=64,
     )
-    return [dict(row) for row in rows]
+    async with conn.transaction():
+        async for row in cursor:
+            yield dict(row)
 
 
 async def _reprocess_skill(
@@ -159,8 +192,7 @@ async def _reprocess_skill(
 
     raw_examples = skills._normalize_examples(row.get("examples"))
     user_query = _pick_user_query(entrypoint, name, raw_examples)
-    base_output = _build_base_output(description, [step.model_dump() for step in steps], raw_examples)
-    base_output = skills._clamp_text(base_output, 2400)
+    base_output = _build_base_output(description, steps, raw_examples)
 
     draft = skills.SkillDefinition(
         name=name,
@@ -180,34 +212,17 @@ async def _reprocess_skill(
     )
 
     if generalized:
-        normalized = skills._normalize_skill_definition(
-            skills.SkillDefinition(
-                name=generalized.name,
-                description=generalized.description,
-                entrypoint=generalized.entrypoint,
-                steps=generalized.steps,
-            ),
+        result = skills._normalize_generalized_skill(
+            generalized,
             user_query,
+            {"userInput": user_query, "outputSummary": base_output},
         )
-        parameters = skills._normalize_parameters(generalized.parameters)
-        preconditions = skills._normalize_string_list(
-            generalized.preconditions,
-            max_items=skills.SKILLS_MAX_PRECONDITIONS,
-            max_len=260,
-        )
-        success_criteria = skills._normalize_string_list(
-            generalized.successCriteria,
-            max_items=skills.SKILLS_MAX_SUCCESS_CRITERIA,
-            max_len=260,
-        )
-        examples = skills._normalize_examples(
-            generalized.examples,
-            fallback={"userInput": user_query, "outputSummary": base_output},
-        )
-        generalization_score = generalized.generalizationScore
-        if not isinstance(generalization_score, (int, float)):
-            generalization_score = skills._estimate_generalization_score(normalized, parameters)
-        generalization_score = max(0.0, min(1.0, float(generalization_score)))
+        normalized = result.definition
+        parameters = result.parameters
+        preconditions = result.preconditions
+        success_criteria = result.success_criteria
+        examples = result.examples
+        generalization_score = result.generalization_score
     else:
         normalized = skills._normalize_skill_definition(draft, user_query)
         parameters = skills._normalize_parameters(row.get("parameters"))
@@ -230,12 +245,13 @@ async def _reprocess_skill(
         preconditions=preconditions,
         success_criteria=success_criteria,
     )
-    embedding = await skills._embed_text(api_key, embedding_text, base_url)
-    if not embedding:
-        return None
-
     steps_payload = [step.model_dump() for step in normalized.steps]
-    created_at = row.get("created_at") or datetime.utcnow()
+    created_at = row.get("created_at") or datetime.now(timezone.utc)
+    embedding_hash = skills._embedding_text_hash(embedding_text)
+    # Unchanged text keeps the stored embedding; only edited skills go back to the embeddings API.
+    embedding = None
+    if row.get("embedding_hash") == embedding_hash:
+        embedding = skills._normalize_embedding(row.get("embedding"))
 
     return ReprocessedSkill(
         skill_id=str(row["id"]),
@@ -246,18 +262,15 @@ async def _reprocess_skill(
         success_criteria=success_criteria,
         examples=examples,
         generalization_score=generalization_score,
-        embedding=embedding,
+        embedding_text=embedding_text,
         steps_payload=steps_payload,
+        step_tokens=skills._step_token_sets(steps_payload),
+        embedding_hash=embedding_hash,
+        embedding=embedding,
     )
 
 
-async def _merge_cluster(
-    *,
-    pool: asyncpg.Pool,
-    cluster: list[ReprocessedSkill],
-    api_key: str,
-    base_url: str | None,
-) -> tuple[str, str]:
+def _plan_cluster_merge(cluster: list[ReprocessedSkill]) -> ClusterMerge:
     if not cluster:
         raise ValueError("empty_cluster")
     base = max(
@@ -298,50 +311,75 @@ async def _merge_cluster(
         preconditions=merged_preconditions,
         success_criteria=merged_success,
     )
-    embedding = await skills._embed_text(api_key, embedding_text, base_url)
-    if not embedding:
-        embedding = base.embedding
-
-    new_version_id = await skills._save_skill_merge(
-        pool,
-        skill_id=base.skill_id,
-        definition=base.definition,
-        embedding=embedding,
+    return ClusterMerge(
+        base=base,
         parameters=merged_params,
         preconditions=merged_preconditions,
         success_criteria=merged_success,
         examples=merged_examples,
         generalization_score=merged_score,
+        embedding_text=embedding_text,
+        embedding_hash=skills._embedding_text_hash(embedding_text),
     )
-    return base.skill_id, new_version_id
 
 
-async def _apply_merge(
-    *,
+async def _save_cluster_merge(
     pool: asyncpg.Pool,
-    base_skill_id: str,
-    version_id: str,
-    merged_skill_ids: list[str],
-) -> None:
-    if not merged_skill_ids:
+    plan: ClusterMerge,
+    embedding: np.ndarray,
+    embedding_hash: bytes | None,
+) -> str:
+    return await skills._save_skill_merge(
+        pool,
+        skill_id=plan.base.skill_id,
+        definition=plan.base.definition,
+        embedding=embedding,
+        parameters=plan.parameters,
+        preconditions=plan.preconditions,
+        success_criteria=plan.success_criteria,
+        examples=plan.examples,
+        generalization_score=plan.generalization_score,
+        embedding_hash=embedding_hash,
+    )
+
+
+# Repoints the merged skills' runs to their base skill's new version and deletes the merged skills.
+_APPLY_MERGES_SQL = """
+    WITH moved AS (
+        UPDATE assistant_skill_runs r
+           SET skill_id = m.base_id,
+               skill_version_id = m.version_id,
+               updated_at = NOW()
+          FROM reprocess_merge_map m
+         WHERE r.skill_id = m.merged_id
+    )
+    DELETE FROM assistant_skills
+     WHERE id IN (SELECT merged_id FROM reprocess_merge_map)
+    """
+
+
+async def _apply_merges(pool: asyncpg.Pool, merges: list[tuple[str, str, str]]) -> None:
+    # `merges` holds (base_skill_id, version_id, merged_skill_id) for every absorbed skill. They are
+    # streamed in with COPY and applied in one transaction rather than a statement per cluster.
+    if not merges:
         return
     async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            UPDATE assistant_skill_runs
-               SET skill_id = $1,
-                   skill_version_id = $2,
-                   updated_at = NOW()
-             WHERE skill_id = ANY($3::text[])
-            """,
-            base_skill_id,
-            version_id,
-            merged_skill_ids,
-        )
-        await conn.execute(
-            "DELETE FROM assistant_skills WHERE id = ANY($1::text[])",
-            merged_skill_ids,
-        )
+        async with conn.transaction():
+            await conn.execute(
+                """
+                CREATE TEMP TABLE reprocess_merge_map (
+                    base_id TEXT NOT NULL,
+                    version_id TEXT NOT NULL,
+                    merged_id TEXT NOT NULL
+                ) ON COMMIT DROP
+                """
+            )
+            await conn.copy_records_to_table(
+                "reprocess_merge_map",
+                records=merges,
+                columns=["base_id", "version_id", "merged_id"],
+            )
+            await conn.execute(_APPLY_MERGES_SQL)
 
 
 async def main() -> None:
@@ -351,9 +389,19 @@ async def main() -> None:
     parser.add_argument("--api-key", dest="api_key", help="OpenAI API key (or set OPENAI_API_KEY).")
     parser.add_argument("--model", dest="model", default="gpt-5.2", help="Model to use.")
     parser.add_argument("--base-url", dest="base_url", default=os.getenv("OPENAI_API_BASE_URL"))
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=int(os.getenv("REPROCESS_CONCURRENCY", "8")),
+        help="Skills reprocessed in parallel (or set REPROCESS_CONCURRENCY).",
+    )
     args = parser.parse_args()
 
-    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"))
+    concurrency = max(1, args.concurrency)
+    # Reprocess workers never touch the database: only the streaming cursor and the merge writes
+    # (run after the stream closes) hold connections, so two cover it whatever the concurrency.
+    pool = await skills._create_pool(os.getenv("DATABASE_URL"), min_size=1, max_size=REPROCESS_DB_CONNECTIONS)
     skills.POOL = pool
     skills.VECTOR_ENABLED = await skills._detect_vector_extension(pool)
 
@@ -363,74 +411,143 @@ async def main() -> None:
         if not api_key:
             await pool.close()
             raise SystemExit("Missing API key. Provide --api-key or OPENAI_API_KEY.")
-        rows = await _fetch_skills(conn, user_id)
-
-    if not rows:
+        # Rows feed `concurrency` workers as the cursor yields them, so the LLM calls overlap the
+        # fetch; the bounded queue stops the cursor from racing ahead of the workers.
+        queue: asyncio.Queue[tuple[int, dict[str, Any]] | None] = asyncio.Queue(maxsize=concurrency * 2)
+        results: list[tuple[int, ReprocessedSkill]] = []
+
+        async def worker() -> None:
+            while (item := await queue.get()) is not None:
+                position, row = item
+                try:
+                    # A per-skill deadline, so one wedged skill cannot stall its worker for the run.
+                    result = await asyncio.wait_for(
+                        _reprocess_skill(
+                            row=row,
+                            api_key=api_key,
+                            model=args.model,
+                            base_url=args.base_url,
+                        ),
+                        timeout=skills.SKILLS_LLM_TIMEOUT_S * 2,
+                    )
+                except asyncio.TimeoutError:
+                    print(f"Skill {row.get('id')} timed out")
+                    continue
+                except Exception as exc:
+                    print(f"Skill {row.get('id')} failed: {exc}")
+                    continue
+                if result:
+                    results.append((position, result))
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        total = 0
+        try:
+            async for row in _stream_skills(conn, user_id):
+                await queue.put((total, row))
+                total += 1
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    if not total:
         print("No skills found.")
         await pool.close()
         return
 
-    candidates: list[ReprocessedSkill] = []
-    for row in rows:
-        item = await _reprocess_skill(
-            row=row,
-            api_key=api_key,
-            model=args.model,
-            base_url=args.base_url,
-        )
-        if item:
-            candidates.append(item)
+    # Workers finish out of order; restore the created_at order the rows were fetched in.
+    results.sort(key=lambda item: item[0])
+    reprocessed = [result for _, result in results]
+
+    # One batched embeddings request for the skills whose stored embedding is stale.
+    stale = [item for item in reprocessed if item.embedding is None]
+    embeddings = await skills._embed_texts(api_key, [item.embedding_text for item in stale], args.base_url)
+    for item, embedding in zip(stale, embeddings):
+        item.embedding = embedding
+    candidates = [item for item in reprocessed if item.embedding is not None]
 
     if not candidates:
         print("No skills reprocessed (embedding failed).")
+        await skills._close_openai_http_client()
         await pool.close()
         return
 
     count = len(candidates)
     parent = list(range(count))
+    rank = [0] * count
 
     def find(x: int) -> int:
+        # Path halving: every visited node skips to its grandparent.
         while parent[x] != x:
             parent[x] = parent[parent[x]]
             x = parent[x]
         return x
 
     def union(a: int, b: int) -> None:
+        # Union by rank keeps trees shallow, so find stays near-constant however merges chain.
         root_a = find(a)
         root_b = find(b)
-        if root_a != root_b:
-            parent[root_b] = root_a
-
-    for i in range(count):
-        for j in range(i + 1, count):
-            score = _merge_score(candidates[i], candidates[j])
-            if score >= skills.SKILLS_MERGE_SIMILARITY_THRESHOLD:
-                union(i, j)
+        if root_a == root_b:
+            return
+        if rank[root_a] < rank[root_b]:
+            root_a, root_b = root_b, root_a
+        parent[root_b] = root_a
+        if rank[root_a] == rank[root_b]:
+            rank[root_a] += 1
+
+    # The merge score is max(0.7 * sim + 0.3 * step, sim + eps, step), and the weighted term never
+    # exceeds the larger of the other two. A pair therefore merges when either the boosted embedding
+    # similarity or the step similarity clears the threshold on its own.
+    threshold = skills.SKILLS_MERGE_SIMILARITY_THRESHOLD
+    matrix = np.stack([item.embedding for item in candidates]).astype(np.float32, copy=False)
+    # Embeddings are unit length, so one matmul gives every pairwise cosine similarity.
+    similarity = np.minimum(matrix @ matrix.T + skills.SKILLS_MERGE_SIMILARITY_EPS, 1.0)
+    similar = similarity >= threshold
+    if STEP_SIMILARITY_MARGIN is None:
+        near = np.triu(np.ones_like(similar), k=1)
+    else:
+        # Only the sparse set of near pairs reaches Python; the rest of the N^2 grid is never visited.
+        near = np.triu(similarity >= threshold - STEP_SIMILARITY_MARGIN, k=1)
+    for i, j in zip(*(idx.tolist() for idx in np.nonzero(near))):
+        if similar[i, j]:
+            union(i, j)
+        elif find(i) != find(j) and (
+            skills._step_token_similarity(candidates[i].step_tokens, candidates[j].step_tokens) >= threshold
+        ):
+            union(i, j)
 
     clusters: dict[int, list[ReprocessedSkill]] = {}
     for idx, item in enumerate(candidates):
         clusters.setdefault(find(idx), []).append(item)
 
-    merged_total = 0
-    for cluster in clusters.values():
-        base_skill_id, version_id = await _merge_cluster(
-            pool=pool,
-            cluster=cluster,
-            api_key=api_key,
-            base_url=args.base_url,
+    plans = [_plan_cluster_merge(cluster) for cluster in clusters.values()]
+    # Singleton clusters (and merges that add nothing) keep the base text, so its embedding carries over.
+    merged_embeddings: list[np.ndarray | None] = [
+        plan.base.embedding if plan.embedding_hash == plan.base.embedding_hash else None for plan in plans
+    ]
+    missing = [idx for idx, embedding in enumerate(merged_embeddings) if embedding is None]
+    fetched = await skills._embed_texts(api_key, [plans[idx].embedding_text for idx in missing], args.base_url)
+    for idx, embedding in zip(missing, fetched):
+        merged_embeddings[idx] = embedding
+
+    merges: list[tuple[str, str, str]] = []
+    for cluster, plan, embedding in zip(clusters.values(), plans, merged_embeddings):
+        base_skill_id = plan.base.skill_id
+        # On an embedding failure the base vector stands in, with its own hash so the next run retries.
+        if embedding is not None:
+            version_id = await _save_cluster_merge(pool, plan, embedding, plan.embedding_hash)
+        else:
+            version_id = await _save_cluster_merge(pool, plan, plan.base.embedding, plan.base.embedding_hash)
+        merges.extend(
+            (base_skill_id, version_id, item.skill_id) for item in cluster if item.skill_id != base_skill_id
         )
-        merged_ids = [item.skill_id for item in cluster if item.skill_id != base_skill_id]
-        if merged_ids:
-            await _apply_merge(
-                pool=pool,
-                base_skill_id=base_skill_id,
-                version_id=version_id,
-                merged_skill_ids=merged_ids,
-            )
-            merged_total += len(merged_ids)
+    await _apply_merges(pool, merges)
 
+    await skills._close_openai_http_client()
     await pool.close()
-    print(f"Reprocessed skills: {len(candidates)} clusters={len(clusters)} merged={merged_total}")
+    print(f"Reprocessed skills: {len(candidates)} clusters={len(clusters)} merged={len(merges)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+
+APP_PATH = Path(__file__).resolve().parents[1] / "app.py"
+
+
+def load_app_module():
+    app_dir = str(APP_PATH.parent)
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    return importlib.import_module("app")
+
+
+@pytest.fixture(scope="session")
+def app_mod():
+    return load_app_module()
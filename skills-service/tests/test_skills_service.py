@@ -0,0 +1,375 @@
+import asyncio
+import types
+
+import httpx
+import openai
+import pytest
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, *, model, input):
+        self.calls.append(input)
+        items = input if isinstance(input, list) else [input]
+        return types.SimpleNamespace(data=[
+            types.SimpleNamespace(index=idx, embedding=[1.0, float(idx), 0.5])
+            for idx, _ in enumerate(items)
+        ])
+
+
+@pytest.fixture
+def fake_embeddings(app_mod, monkeypatch):
+    embeddings = FakeEmbeddings()
+    client = types.SimpleNamespace(embeddings=embeddings)
+    monkeypatch.setattr(app_mod, "_get_openai_client", lambda api_key, base_url: client)
+    app_mod._embedding_cache.clear()
+    yield embeddings
+    app_mod._embedding_cache.clear()
+
+
+@pytest.fixture
+def record_stubs(app_mod, monkeypatch):
+    saved = {}
+    draft = app_mod.SkillDefinition(
+        name="Draft plan",
+        description="Draft",
+        entrypoint="plan a trip",
+        steps=[app_mod.SkillStep(title="Plan", instructions="Plan the trip")],
+    )
+    generalized = app_mod.GeneralizedSkillDefinition(
+        name="Plan a trip to {city}",
+        description="Plans a trip to any city.",
+        entrypoint="Plan a trip to {city}",
+        steps=[
+            app_mod.SkillStep(title="Research", instructions="Research {city} sights"),
+            app_mod.SkillStep(title="Itinerary", instructions="Draft a {days}-day itinerary"),
+        ],
+        parameters=[
+            app_mod.SkillParameter(name="city", description="Destination"),
+            app_mod.SkillParameter(name="days", description="Trip length"),
+        ],
+        generalizationScore=0.9,
+    )
+
+    async def decompose(**_kwargs):
+        return draft
+
+    async def generalize(**_kwargs):
+        return generalized
+
+    async def find_skill(_pool, _user_id, embedding):
+        saved["lookup_embedding"] = embedding
+        return None, None
+
+    async def save_skill(_pool, user_id, definition, embedding, **_kwargs):
+        saved["skill"] = (user_id, definition.name, embedding)
+        return "skill-1", "version-1"
+
+    async def update_run(_pool, **kwargs):
+        saved["run_link"] = kwargs
+
+    monkeypatch.setattr(app_mod, "POOL", object())
+    monkeypatch.setattr(app_mod, "SKILLS_GENERALIZATION_THRESHOLD", 0.0)
+    monkeypatch.setattr(app_mod, "_decompose_skill", decompose)
+    monkeypatch.setattr(app_mod, "_generalize_skill", generalize)
+    monkeypatch.setattr(app_mod, "_find_skill", find_skill)
+    monkeypatch.setattr(app_mod, "_save_skill", save_skill)
+    monkeypatch.setattr(app_mod, "_update_skill_run_skill", update_run)
+    return saved
+
+
+async def test_record_skill_embeds_final_text_once(app_mod, fake_embeddings, record_stubs):
+    await app_mod._record_skill_background(
+        run_id="run-1",
+        user_id="user-1",
+        api_key="sk-test",
+        model="gpt-5.2",
+        base_url=None,
+        user_query="Plan a trip to Rome for 3 days",
+        base_output="Day 1: Colosseum",
+        trace=None,
+    )
+
+    assert len(fake_embeddings.calls) == 1
+    assert "Plan a trip to {city}" in fake_embeddings.calls[0]
+    assert record_stubs["skill"][1] == "Plan a trip to {city}"
+    assert record_stubs["lookup_embedding"] is record_stubs["skill"][2]
+    assert record_stubs["run_link"]["run_id"] == "run-1"
+
+
+class FakeConn:
+    def __init__(self, rows, on_fetch=None):
+        self.rows = rows
+        self.on_fetch = on_fetch
+        self.fetches = 0
+
+    async def fetch(self, *_args):
+        self.fetches += 1
+        if self.on_fetch:
+            self.on_fetch()
+        return self.rows
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        pool = self
+
+        class _Acquire:
+            async def __aenter__(self):
+                return pool.conn
+
+            async def __aexit__(self, *_exc):
+                return False
+
+        return _Acquire()
+
+
+@pytest.fixture
+def skill_cache(app_mod):
+    app_mod._SKILL_CACHE.clear()
+    app_mod._SKILL_CACHE_LOCKS.clear()
+    app_mod._SKILL_CACHE_WRITES.clear()
+    yield app_mod
+    app_mod._SKILL_CACHE.clear()
+    app_mod._SKILL_CACHE_LOCKS.clear()
+    app_mod._SKILL_CACHE_WRITES.clear()
+
+
+async def test_skill_matrix_caches_over_cap_marker(skill_cache, monkeypatch):
+    app_mod = skill_cache
+    monkeypatch.setattr(app_mod, "SKILLS_EMBEDDING_CACHE_MAX_ROWS", 2)
+    conn = FakeConn([{"id": f"s{idx}", "embedding": [1.0, 0.0]} for idx in range(3)])
+    pool = FakePool(conn)
+
+    assert await app_mod._load_skill_matrix(pool, "user-1") is None
+    assert await app_mod._load_skill_matrix(pool, "user-1") is None
+    assert conn.fetches == 1
+
+    app_mod._invalidate_skill_cache("user-1")
+    assert await app_mod._load_skill_matrix(pool, "user-1") is None
+    assert conn.fetches == 2
+
+
+async def test_skill_matrix_drops_lock_when_nothing_is_cached(skill_cache, monkeypatch):
+    app_mod = skill_cache
+    monkeypatch.setattr(app_mod, "OPENAI_EMBEDDING_DIM", 2)
+    # A write racing the read makes the snapshot stale, so it is returned but not cached.
+    conn = FakeConn([{"id": "s1", "embedding": [1.0, 0.0]}], on_fetch=lambda: app_mod._invalidate_skill_cache("user-1"))
+
+    matrix, ids = await app_mod._load_skill_matrix(FakePool(conn), "user-1")
+
+    assert ids == ["s1"] and matrix.shape == (1, 2)
+    assert "user-1" not in app_mod._SKILL_CACHE
+    assert "user-1" not in app_mod._SKILL_CACHE_LOCKS
+
+
+def _openai_status_error(status):
+    request = httpx.Request("POST", "https://api.openai.test/v1/embeddings")
+    return openai.APIStatusError(f"status {status}", response=httpx.Response(status, request=request), body=None)
+
+
+@pytest.fixture
+def breakers(app_mod, monkeypatch):
+    monkeypatch.setattr(app_mod, "SKILLS_CIRCUIT_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(app_mod, "SKILLS_CIRCUIT_RESET_S", 30.0)
+    app_mod._circuit_breakers.clear()
+    yield app_mod
+    app_mod._circuit_breakers.clear()
+
+
+def test_circuit_breaker_opens_after_threshold_and_half_opens(app_mod):
+    breaker = app_mod.CircuitBreaker(2, 30.0)
+
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    # After the cooldown exactly one probe goes through; a failing probe re-opens the circuit.
+    breaker.opened_at -= 30.0
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    # An inconclusive probe frees the slot; a successful one closes the circuit.
+    breaker.opened_at -= 30.0
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+
+async def test_per_key_openai_errors_do_not_trip_shared_breaker(breakers):
+    app_mod = breakers
+
+    for status in (401, 429, 401, 429):
+        async def request(status=status):
+            raise _openai_status_error(status)
+
+        with pytest.raises(openai.APIStatusError):
+            await app_mod._call_openai(None, request)
+
+    breaker = app_mod._circuit_breaker(app_mod.OPENAI_API_BASE_URL)
+    assert breaker.state == "closed" and breaker.failures == 0
+
+    async def server_error():
+        raise _openai_status_error(500)
+
+    for _ in range(2):
+        with pytest.raises(openai.APIStatusError):
+            await app_mod._call_openai(None, server_error)
+    assert breaker.state == "open"
+
+    async def never_called():
+        raise AssertionError("request sent while the circuit is open")
+
+    with pytest.raises(app_mod.CircuitOpenError):
+        await app_mod._call_openai(None, never_called)
+
+
+@pytest.fixture
+def agent_transport(breakers, monkeypatch):
+    app_mod = breakers
+    state = {"calls": 0, "handler": None}
+
+    def handle(request):
+        state["calls"] += 1
+        return state["handler"](request)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    monkeypatch.setattr(app_mod, "_get_agent_client", lambda: client)
+    monkeypatch.setattr(app_mod, "AGENT_SERVICE_RETRY_BASE_MS", 0)
+    monkeypatch.setattr(app_mod, "AGENT_SERVICE_RETRIES", 2)
+    yield state
+
+
+async def test_agent_5xx_response_is_returned_without_retry(app_mod, agent_transport):
+    agent_transport["handler"] = lambda request: httpx.Response(
+        503, json={"detail": {"error": "openai_unavailable", "message": "upstream busy"}}
+    )
+
+    with pytest.raises(app_mod.HTTPException) as excinfo:
+        await app_mod._call_agent_service({"input": []})
+
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.detail == {"error": "openai_unavailable", "message": "upstream busy"}
+    assert agent_transport["calls"] == 1
+    # The agent answered, so the breaker treats it as reachable.
+    assert app_mod._circuit_breaker(app_mod.AGENT_SERVICE_URL).state == "closed"
+
+
+async def test_agent_connect_error_is_retried_then_opens_breaker(app_mod, agent_transport):
+    def refuse(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    agent_transport["handler"] = refuse
+
+    for expected_calls in (3, 6):
+        with pytest.raises(httpx.ConnectError):
+            await app_mod._call_agent_service({"input": []})
+        assert agent_transport["calls"] == expected_calls
+
+    with pytest.raises(app_mod.HTTPException) as excinfo:
+        await app_mod._call_agent_service({"input": []})
+    assert excinfo.value.status_code == 503
+    assert agent_transport["calls"] == 6
+
+    responses = iter([None, {"output": "done"}])
+
+    def flaky(request):
+        body = next(responses)
+        if body is None:
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(200, json=body)
+
+    agent_transport["handler"] = flaky
+    app_mod._circuit_breaker(app_mod.AGENT_SERVICE_URL).opened_at -= 30.0
+    result = await app_mod._call_agent_service({"input": []})
+    assert result.output == "done"
+    assert app_mod._circuit_breaker(app_mod.AGENT_SERVICE_URL).state == "closed"
+
+
+def test_step_dependencies_and_waves(app_mod):
+    assert app_mod._step_dependencies({"title": "No deps"}, 2) is None
+    assert app_mod._step_dependencies("not a dict", 2) is None
+    # Forward, self, negative, non-int and bool references are dropped; the rest is deduplicated.
+    assert app_mod._step_dependencies({"dependsOn": [1, 0, 1, 3, 4, -1, "0", True]}, 3) == [0, 1]
+
+    steps = [
+        {"title": "Research"},
+        {"dependsOn": [0]},
+        {"dependsOn": [0]},
+        {"title": "Summarize"},
+        {"dependsOn": []},
+        {"dependsOn": [4]},
+    ]
+    assert app_mod._plan_step_waves(steps) == [[0], [1, 2], [3, 4], [5]]
+    assert app_mod._plan_step_waves([{"dependsOn": []}, {"dependsOn": []}]) == [[0, 1]]
+    assert app_mod._plan_step_waves([{}, {}]) == [[0], [1]]
+    assert app_mod._plan_step_waves([]) == []
+
+
+def test_step_prior_results_selects_declared_dependencies(app_mod):
+    results = [{"index": idx, "output": f"out {idx}"} for idx in range(3)]
+
+    assert app_mod._step_prior_results({"dependsOn": [2, 0]}, 3, results) == [results[0], results[2]]
+    assert app_mod._step_prior_results({"dependsOn": []}, 3, results) == []
+    assert app_mod._step_prior_results({}, 3, results) is results
+
+
+def test_normalize_skill_definition_remaps_depends_on(app_mod, monkeypatch):
+    monkeypatch.setattr(app_mod, "SKILLS_MAX_STEPS", 5)
+    defn = app_mod.SkillDefinition(
+        name="Plan a trip",
+        description="Plans a trip.",
+        entrypoint="plan a trip",
+        steps=[
+            app_mod.SkillStep(title="Research", instructions="Research sights"),
+            app_mod.SkillStep(title="Empty", instructions="   "),
+            app_mod.SkillStep(title="Hotels", instructions="Find hotels", dependsOn=[0, 1]),
+            app_mod.SkillStep(title="Itinerary", instructions="Draft the plan", dependsOn=[2, 0, 7]),
+            app_mod.SkillStep(title="Summary", instructions="Summarize"),
+            app_mod.SkillStep(title="Dropped", instructions="Over the step cap", dependsOn=[0]),
+        ],
+    )
+
+    steps = app_mod._normalize_skill_definition(defn, "plan a trip").steps
+
+    assert [step.title for step in steps] == ["Research", "Hotels", "Itinerary", "Summary"]
+    assert [step.dependsOn for step in steps] == [None, [0], [0, 1], None]
+
+
+async def test_step_wave_cancels_siblings_on_failure(app_mod):
+    cancelled = asyncio.Event()
+
+    async def slow_step():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def failing_step():
+        await asyncio.sleep(0)
+        raise app_mod.HTTPException(status_code=502, detail={"error": "agent_failed"})
+
+    with pytest.raises(app_mod.HTTPException) as excinfo:
+        await app_mod._run_step_wave([slow_step(), failing_step()])
+
+    assert excinfo.value.status_code == 502
+    assert cancelled.is_set()
+
+    async def step(value):
+        await asyncio.sleep(0)
+        return value
+
+    assert await app_mod._run_step_wave([step("a"), step("b")]) == ["a", "b"]